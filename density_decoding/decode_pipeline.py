@@ -1,19 +1,22 @@
-import os
-import random
-import numpy as np
 import torch
 import warnings
 
-from density_decoding.utils.utils import set_seed, to_device
+from density_decoding.utils.utils import set_seed, to_device, ConvergenceMonitor
 from density_decoding.utils.data_utils import initilize_gaussian_mixtures
+from density_decoding.utils.binning import as_binned_spikes
+from density_decoding.utils.gmm_cache import get_gmm_cache
 
 from density_decoding.models.advi import (
     ModelDataLoader, 
     ADVI, 
+    FoldADVI,
     train_advi,
+    train_fold_advi,
     compute_posterior_weight_matrix, 
 )
 
+from density_decoding.models.gaussian import GaussianComponentBank
+
 from density_decoding.models.cavi import (
     CAVI, 
     compute_lambda_for_cavi,
@@ -44,11 +47,36 @@ def decode_pipeline(
     cavi_max_iter=10,
     fast_compute=True,
     stochastic=True,
+    n_mc_samples=1,
+    rtol=None,
+    patience=10,
     penalty_strength=1,
     device=torch.device("cpu"),
-    n_workers=4
+    n_workers=4,
+    gmm_cache_dir=None,
+    pool=None,
+    prune_tol=None,
+    n_neighbors=None
 ):
-    """Run the decoding pipeline."""
+    """
+    Run the decoding pipeline.
+    
+    The fitted GMM is memoized across calls in the same process (e.g., folds); 
+    pass gmm_cache_dir to also save it to disk for reruns. With n_mc_samples > 1, 
+    ADVI averages the ELBO gradient over a batch of MC samples at each step. 
+    If rtol is set, ADVI stops once the relative change of the smoothed ELBO stays 
+    below rtol for `patience` iterations (CAVI always stops at its own tolerance).
+    
+    To train the ADVI models of several folds jointly, use decode_folds_pipeline.
+    
+    Multiprocessing stages (GMM initialization, weight matrix) run on `pool` 
+    (a WorkerPool owned by the caller) or on the process-wide pool w/ n_workers.
+    
+    If prune_tol or n_neighbors is set, the weight matrices evaluate each spike only 
+    under the mixture components near it (see GaussianComponentBank). ADVI training 
+    is only pruned by n_neighbors, since the prune_tol bound depends on the mixing 
+    proportions being learned.
+    """
     
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -71,19 +99,13 @@ def decode_pipeline(
             seed=seed
         )
 
-        spike_features = np.concatenate(
-            np.concatenate(bin_spike_features)
-        )
+        bin_spike_features = as_binned_spikes(bin_spike_features)
 
-        gmm = initilize_gaussian_mixtures(
-            spike_features=spike_features[:,1:], 
-            spike_channels=spike_features[:,0], 
-            method=gmm_init_method, 
-            verbose=False
+        gmm = _init_gaussian_mixtures(
+            bin_spike_features, gmm_init_method, n_workers, gmm_cache_dir, pool
         )
         n_t = data_loader.n_t_bins
         n_c = gmm.means_.shape[0]
-        n_d = gmm.means_.shape[1]
         print(f"Initialized a mixture with {n_c} components.")
 
         model_data_loader = ModelDataLoader(
@@ -97,7 +119,7 @@ def decode_pipeline(
             model_data_loader.bin_behaviors = model_data_loader.bin_behaviors.reshape(-1,1)
             
         train_spike_features, train_trial_idxs, train_time_idxs, \
-        test_spike_features, test_trial_idxs, test_time_idxs = \
+        _, test_trial_idxs, test_time_idxs = \
         model_data_loader.split_train_test(train, test)
 
         if inference == "advi":
@@ -105,12 +127,14 @@ def decode_pipeline(
             advi = ADVI(
                 n_t=n_t, 
                 gmm=gmm, 
-                device=device
+                device=device,
+                prune_tol=prune_tol,
+                n_neighbors=n_neighbors
             )
             
             batch_idxs = list(zip(*(iter(train),) * batch_size))
             
-            elbos = train_advi(
+            train_advi(
                 advi,
                 spike_features = to_device(train_spike_features[:,1:], device), 
                 behaviors = to_device(model_data_loader.bin_behaviors, device), 
@@ -120,7 +144,12 @@ def decode_pipeline(
                 optim = torch.optim.Adam(advi.parameters(), lr=learning_rate),
                 max_iter=max_iter,
                 fast_compute=fast_compute,
-                stochastic=stochastic
+                stochastic=stochastic,
+                n_mc_samples=n_mc_samples,
+                # smooth the noisy minibatch ELBOs before checking convergence
+                monitor=ConvergenceMonitor(
+                    rtol=rtol, patience=patience, smoothing=.99 if stochastic else 0.
+                )
             )
             
             parameters = advi.parameters()
@@ -130,10 +159,11 @@ def decode_pipeline(
                 "beta": advi.beta.loc.numpy(),
                 "means": advi.means.numpy(),
                 "covs": advi.covs.numpy(),
+                "components": advi.components,
             }
 
-            mixture_weights, weight_matrix = compute_posterior_weight_matrix(
-                bin_spike_features, y_train, y_pred, train, test, post_params, n_workers
+            _, weight_matrix = compute_posterior_weight_matrix(
+                bin_spike_features, y_train, y_pred, train, test, post_params, n_workers, pool
             )
 
         else:
@@ -162,7 +192,7 @@ def decode_pipeline(
                 ).reshape(-1) for t in range(n_t)]
             )
 
-            encoded_r, encoded_lam, encoded_mu, encoded_cov, elbos = cavi.encode(
+            _, encoded_lam, _, _, _ = cavi.encode(
                 s = train_spike_features[:,1:],
                 y = train_behaviors, 
                 max_iter = cavi_max_iter
@@ -172,11 +202,138 @@ def decode_pipeline(
                 "lambdas": encoded_lam.numpy(),
                 "means": gmm.means_,
                 "covs": gmm.covariances_,
+                "components": GaussianComponentBank(
+                    gmm.means_, gmm.covariances_, prune_tol=prune_tol, n_neighbors=n_neighbors
+                ),
             }
 
-            mixture_weights, weight_matrix = compute_cavi_weight_matrix(
+            _, weight_matrix = compute_cavi_weight_matrix(
                 bin_spike_features, y_train, y_pred, train, test, post_params
             )
 
     return weight_matrix
 
+
+def _init_gaussian_mixtures(bin_spike_features, gmm_init_method, n_workers, gmm_cache_dir, pool):
+    """Fit (or load from the cache) the GMM used to initialize ADVI / CAVI."""
+    
+    spike_features = bin_spike_features.spike_features
+    
+    return initilize_gaussian_mixtures(
+        spike_features=spike_features[:,1:], 
+        spike_channels=spike_features[:,0], 
+        method=gmm_init_method, 
+        verbose=False,
+        n_workers=n_workers,
+        cache=get_gmm_cache(gmm_cache_dir),
+        pool=pool
+    )
+
+
+def decode_folds_pipeline(
+    data_loader, 
+    bin_spike_features,
+    bin_trial_idxs,
+    bin_time_idxs,
+    thresholded_spike_count,
+    bin_behaviors,
+    behavior_type,
+    trains,
+    tests,
+    gmm_init_method="isosplit",
+    batch_size=1,
+    learning_rate=1e-2,
+    max_iter=500,
+    fast_compute=True,
+    stochastic=True,
+    n_mc_samples=1,
+    rtol=None,
+    patience=10,
+    penalty_strength=1,
+    device=torch.device("cpu"),
+    n_workers=4,
+    gmm_cache_dir=None,
+    pool=None,
+    prune_tol=None,
+    n_neighbors=None
+):
+    """
+    Run the ADVI decoding pipeline for several cross-validation folds at once.
+        
+    The ADVI models of all folds are trained jointly on the shared spike data 
+    (see train_fold_advi); each fold only sees its own train trials and stops 
+    at its own convergence, so the result is the same as calling decode_pipeline 
+    for each fold. The arguments are the same as decode_pipeline (w/o inference 
+    and cavi_max_iter), except for trains / tests (a list of train / test trial 
+    index per fold).
+        
+    Returns:
+        weight_matrices: a list of size (n_k, n_c, n_t) arrays (one per fold)
+    """
+        
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        
+        valid_types = ["discrete", "continuous"]
+        assert behavior_type in valid_types, f"invalid behavior type; expected one of {valid_types}."
+        
+        fast_compute = False if data_loader.type == "custom" else fast_compute
+        
+        decoded = [generic_decoder(
+            thresholded_spike_count, 
+            bin_behaviors, 
+            train, 
+            test, 
+            behavior_type=behavior_type,
+            penalty_strength=penalty_strength,
+            seed=seed
+        ) for train, test in zip(trains, tests)]
+        
+        bin_spike_features = as_binned_spikes(bin_spike_features)
+        spike_features = bin_spike_features.spike_features
+        
+        gmm = _init_gaussian_mixtures(
+            bin_spike_features, gmm_init_method, n_workers, gmm_cache_dir, pool
+        )
+        print(f"Initialized a mixture with {gmm.means_.shape[0]} components.")
+        
+        behaviors = bin_behaviors.reshape(-1,1) if behavior_type == "discrete" else bin_behaviors
+        
+        advi = FoldADVI(
+            n_folds=len(trains),
+            n_t=data_loader.n_t_bins, 
+            gmm=gmm, 
+            device=device,
+            prune_tol=prune_tol,
+            n_neighbors=n_neighbors
+        )
+        
+        # every fold sees the spikes of its own train trials only
+        train_fold_advi(
+            advi,
+            spike_features = to_device(spike_features[:,1:], device), 
+            behaviors = to_device(behaviors, device), 
+            trial_idxs = to_device(bin_spike_features.trial_idxs, device), 
+            time_idxs = to_device(bin_spike_features.time_idxs, device), 
+            fold_batch_idxs = [list(zip(*(iter(train),) * batch_size)) for train in trains], 
+            optim = torch.optim.Adam(advi.parameters(), lr=learning_rate),
+            max_iter=max_iter,
+            fast_compute=fast_compute,
+            stochastic=stochastic,
+            n_mc_samples=n_mc_samples,
+            # smooth the noisy minibatch ELBOs before checking convergence
+            monitor=ConvergenceMonitor(
+                rtol=rtol, patience=patience, smoothing=.99 if stochastic else 0.
+            )
+        )
+        
+        weight_matrices = []
+        for fold, (train, test) in enumerate(zip(trains, tests)):
+            y_train, _, y_pred, _ = decoded[fold]
+            _, weight_matrix = compute_posterior_weight_matrix(
+                bin_spike_features, y_train, y_pred, train, test, 
+                advi.fold_posterior_params(fold), n_workers, pool
+            )
+            weight_matrices.append(weight_matrix)
+        
+        return weight_matrices
@@ -1,11 +1,19 @@
+import copy
 import numpy as np
 from tqdm import tqdm
-import multiprocessing
 from scipy.special import logsumexp
-from sklearn.mixture import GaussianMixture
 import torch
 import torch.distributions as D
 
+from density_decoding.utils.utils import ConvergenceMonitor
+from density_decoding.utils.worker_pool import get_worker_pool
+from density_decoding.utils.binning import as_binned_spikes, concat_ranges, group_by_key
+from density_decoding.models.gaussian import GaussianComponentBank, SparseLogProb, csr_logsumexp
+
+
+# largest number of (spike, component) log-densities precomputed for training 
+# (1 GB in float64); above it, they are evaluated for each batch instead
+MAX_CACHED_LOG_LIKELIHOOD = 2**27
 
 
 class ModelDataLoader():
@@ -20,19 +28,19 @@ class ModelDataLoader():
         Data loader for the ADVI / CAVI model. 
         
         Args:
-            bin_spike_features: a nested list w/ the structure:
+            bin_spike_features: a BinnedSpikes container or a nested list w/ the structure:
                                 for each k:
                                     for each t:
                                         size (n_t_k, 1+n_d) array, n_d = spike feature dim
             bin_behaviors: size (n_k, n_t) array
-            bin_trial_idxs: a list of trial index
-            bin_time_idxs: a list of time bin index
+            bin_trial_idxs: trial index of each spike
+            bin_time_idxs: time bin index of each spike
         """
         
-        self.bin_spike_features = bin_spike_features
+        self.bin_spike_features = as_binned_spikes(bin_spike_features)
         self.bin_behaviors = bin_behaviors
-        self.bin_trial_idxs = bin_trial_idxs
-        self.bin_time_idxs = bin_time_idxs
+        self.bin_trial_idxs = self.bin_spike_features.trial_idxs
+        self.bin_time_idxs = self.bin_spike_features.time_idxs
     
     def split_train_test(self, train, test):
         """Split the trials into train and test sets."""
@@ -40,48 +48,105 @@ class ModelDataLoader():
         self.train_y = self.bin_behaviors[train]
         self.test_y = self.bin_behaviors[test]
         
-        spike_features = np.concatenate(
-            np.concatenate(self.bin_spike_features)
-        )
-        trial_idxs = np.concatenate(self.bin_trial_idxs)
-        time_idxs = np.concatenate(self.bin_time_idxs)
-
-        train_mask = np.sum(
-            [trial_idxs == idx for idx in train], axis=0
-        ).astype(bool)
-        test_mask = np.sum(
-            [trial_idxs == idx for idx in test], axis=0
-        ).astype(bool)
-        
-        train_trial_idxs, test_trial_idxs = trial_idxs[train_mask], trial_idxs[test_mask]
-        train_time_idxs, test_time_idxs = time_idxs[train_mask], time_idxs[test_mask]
-        train_spike_features, test_spike_features = spike_features[train_mask], spike_features[test_mask]
+        train_spike_features, train_trial_idxs, train_time_idxs = \
+            self.bin_spike_features.select_trials(train)
+        test_spike_features, test_trial_idxs, test_time_idxs = \
+            self.bin_spike_features.select_trials(test)
         
         return train_spike_features, train_trial_idxs, train_time_idxs, \
                test_spike_features, test_trial_idxs, test_time_idxs
     
 
 
-class ADVI(torch.nn.Module):
-    def __init__(self, n_t, gmm, device):
+class BaseADVI(torch.nn.Module):
+    def __init__(self, n_t, gmm, device, prune_tol=None, n_neighbors=None):
         super().__init__()
         """
-        ADVI model that handles both continuous and discrete behavioral correlates.
+        Frozen mixture components and their log-likelihood, shared by the ADVI 
+        and FoldADVI models.
         
         Args:
             n_t: number of time bins in a trial 
             gmm: an instance of sklearn's Gaussian mixture model object
             device: the device (CPU or GPU) on which models are allocated
+            prune_tol: pruning bound of the posterior weight matrices (see 
+                       GaussianComponentBank); the training ELBO is not pruned w/ it, 
+                       since the bound depends on the mixing proportions being learned
+            n_neighbors: evaluate each spike only under the n_neighbors components 
+                         w/ the nearest means, in training and in the weight matrices
         """
         
         self.n_t = n_t
         self.n_c, self.n_d = gmm.means_.shape
         self.device = device
         
-        # initialize parameters for variational distribution
         self.means = torch.nn.Parameter(torch.tensor(gmm.means_), requires_grad=False)
         self.covs = torch.nn.Parameter(torch.tensor(gmm.covariances_), requires_grad=False)
         
+        # the mixture components are frozen during training, so the covariances are 
+        # factorized once and the component log-densities of the train set only 
+        # need to be computed once (see precompute_log_likelihood)
+        self.components = GaussianComponentBank(
+            self.means.data, self.covs.data, prune_tol=prune_tol, n_neighbors=n_neighbors
+        )
+        
+        
+    def compute_log_likelihood(self, spike_features):
+        """
+        Evaluate the log-density of every spike under every (frozen) mixture component.
+        
+        Args:
+            spike_features: size (N, n_d) tensor
+            
+        Returns:
+            ll: size (N, n_c) tensor; or if n_neighbors is set, a SparseLogProb w/ the 
+                log-densities of each spike under its n_neighbors nearest components
+        """
+        
+        with torch.no_grad():
+            if self.components.n_neighbors is not None:
+                # w/o mixture weights, prune_tol does not apply (see neighbors)
+                return self.components.sparse_log_prob(spike_features)
+            return self.components.log_prob(spike_features)
+        
+        
+    def precompute_log_likelihood(self, spike_features):
+        """
+        Component log-densities of all train spikes, computed once before training 
+        and sliced for every batch. They take N * n_c entries (N * n_neighbors if 
+        pruned), e.g., ~24 GB for 1e7 spikes and 300 components in float64, so above 
+        MAX_CACHED_LOG_LIKELIHOOD entries they are not precomputed.
+        
+        Args:
+            spike_features: size (N, n_d) tensor
+            
+        Returns:
+            ll: see compute_log_likelihood; None if too large (the log-densities 
+                are then evaluated for each batch)
+        """
+        
+        n_neighbors = self.components.n_neighbors
+        n_entries = len(spike_features) * (self.n_c if n_neighbors is None else min(n_neighbors, self.n_c))
+        if n_entries > MAX_CACHED_LOG_LIKELIHOOD:
+            return None
+        
+        return self.compute_log_likelihood(spike_features)
+    
+    
+class ADVI(BaseADVI):
+    def __init__(self, n_t, gmm, device, prune_tol=None, n_neighbors=None):
+        super().__init__(n_t, gmm, device, prune_tol, n_neighbors)
+        """
+        ADVI model that handles both continuous and discrete behavioral correlates.
+        
+        Args:
+            n_t: number of time bins in a trial 
+            gmm: an instance of sklearn's Gaussian mixture model object
+            device: the device (CPU or GPU) on which models are allocated
+            prune_tol, n_neighbors: see BaseADVI
+        """
+        
+        # initialize parameters for variational distribution
         # b ~ N(b_mu, exp(b_log_sig))
         self.b_mu = torch.nn.Parameter(torch.randn((self.n_c)))
         self.b_log_sig = torch.nn.Parameter(torch.randn((self.n_c)))
@@ -125,7 +190,8 @@ class ADVI(torch.nn.Module):
         time_idxs, 
         model_params, 
         scaling_factor,
-        fast_compute=True
+        fast_compute=True,
+        spike_ll=None
     ):
         """
         Compute the evidence lower bound (ELBO).
@@ -138,7 +204,10 @@ class ADVI(torch.nn.Module):
             time_idxs: size (n_b,) tensor 
             model_params: a dict of model parameters that contains b, beta, means and covs
             scaling_factor: factor to scale the ELBO for stochastic optimization with data subsampling
-            fast_compute: whether to speed up the computation (only when batch_size = 1)
+            fast_compute: whether to gather the mixing proportions of all spikes at once 
+                          (otherwise loop over each trial and time bin)
+            spike_ll: size (n_b, n_c) tensor or SparseLogProb; precomputed component 
+                      log-densities of the batch (computed from spike_features if None)
             
         Returns:
             elbo: float; ELBO
@@ -147,25 +216,24 @@ class ADVI(torch.nn.Module):
         unique_trial_idxs = torch.unique(trial_idxs).int()
         n_k = len(unique_trial_idxs)
         
+        if spike_ll is None:
+            spike_ll = self.compute_log_likelihood(spike_features)
+        # log_pi has a leading sample dim if multiple MC samples are drawn
+        log_pis = model_params["log_pi"]
+        n_samples = model_params["b"].shape[:-1].numel()
+        
         elbo = self._log_prior(model_params["b"], model_params["beta"])
         elbo -= self._log_q(model_params["b"], model_params["beta"])
 
         if fast_compute:
             
-            assert n_k == 1, "fast ELBO computation only works when batch_size = 1."
-            
-            mixing_props = torch.zeros((len(spike_features), self.n_c)).to(self.device)
-            for k in range(n_k):
-                for t in range(self.n_t):
-                    trial_time_idx = torch.logical_and(
-                        trial_idxs == unique_trial_idxs[k], time_idxs == t
-                    )
-                    mixing_props[trial_time_idx] = model_params["pi"][k,:,t]
-
-            mix = D.Categorical(mixing_props)
-            comp = D.MultivariateNormal(self.means, self.covs)
-            gmm = D.MixtureSameFamily(mix, comp)
-            elbo += gmm.log_prob(spike_features).sum() * scaling_factor
+            # local trial slot of each spike within the batch
+            local_trial_idxs = torch.searchsorted(
+                unique_trial_idxs, trial_idxs.to(unique_trial_idxs.dtype)
+            )
+            elbo += _log_mixture_density(
+                spike_ll, log_pis, local_trial_idxs, time_idxs.long()
+            ).sum() * scaling_factor
             
         else:
             for k in range(n_k):
@@ -173,25 +241,30 @@ class ADVI(torch.nn.Module):
                     trial_time_idx = torch.logical_and(
                         trial_idxs == unique_trial_idxs[k], time_idxs == t
                     )
-                    sub_spike_features = spike_features[trial_time_idx]
-                    mix = D.Categorical(model_params["pi"][k,:,t])
-                    comp = D.MultivariateNormal(self.means, self.covs)
-                    gmm = D.MixtureSameFamily(mix, comp)
-                    if len(sub_spike_features) > 0:
-                        elbo += gmm.log_prob(sub_spike_features).sum() * scaling_factor
+                    sub_spike_ll = spike_ll[trial_time_idx]
+                    if len(sub_spike_ll) > 0:
+                        sub_idxs = torch.zeros(len(sub_spike_ll), dtype=torch.long, device=time_idxs.device)
+                        elbo += _log_mixture_density(
+                            sub_spike_ll, log_pis, sub_idxs + k, sub_idxs + t
+                        ).sum() * scaling_factor
+        
+        # average over the MC samples
+        elbo = elbo / n_samples
             
         return elbo
 
 
-    def forward(self, behaviors):
+    def forward(self, behaviors, n_mc_samples=1):
         """
         Performs forward pass computation on the input tensors.
         
         Args:
             behaviors: size (n_k,) or (n_k, n_t) tensor    
+            n_mc_samples: number of MC samples of b and beta drawn in one batch
             
         Returns:
-            model_params: a dict of model parameters that contains b, beta, means and covs
+            model_params: a dict of model parameters that contains b, beta, pi, log_pi and lambda
+                          (w/ a leading dim of size n_mc_samples if n_mc_samples > 1)
         """
         
         n_k = len(behaviors)
@@ -201,16 +274,18 @@ class ADVI(torch.nn.Module):
         self.beta = D.Normal(self.beta_mu, self.beta_log_sig.exp())
         
         # sample from variational distributions
-        b_sample = self.b.rsample()
-        beta_sample = self.beta.rsample()
+        sample_shape = torch.Size([n_mc_samples]) if n_mc_samples > 1 else torch.Size()
+        b_sample = self.b.rsample(sample_shape)
+        beta_sample = self.beta.rsample(sample_shape)
                  
         # compute mixing proportions 
         log_lambdas = torch.zeros((n_k, self.n_c, self.n_t))
-        log_lambdas = (b_sample[None,:,None] + beta_sample[None,:,:] * behaviors[:,None,:])
-        log_pis = log_lambdas - torch.logsumexp(log_lambdas, 1)[:,None,:]
+        log_lambdas = (b_sample[...,None,:,None] + beta_sample[...,None,:,:] * behaviors[:,None,:])
+        log_pis = log_lambdas - torch.logsumexp(log_lambdas, -2)[...,None,:]
                    
         model_params = {
             "pi": log_pis.exp(), 
+            "log_pi": log_pis, 
             "b": b_sample, 
             "beta": beta_sample, 
             "lambda": log_lambdas.exp()
@@ -219,6 +294,186 @@ class ADVI(torch.nn.Module):
         return model_params
     
     
+class FoldADVI(BaseADVI):
+    def __init__(self, n_folds, n_t, gmm, device, prune_tol=None, n_neighbors=None):
+        """
+        ADVI models of several cross-validation folds that are trained jointly. 
+        All folds share the spike data and the frozen mixture components (so the 
+        component log-densities are evaluated once), while each fold has its own 
+        variational parameters and only sees its own train trials.
+        
+        Args:
+            n_folds: number of folds
+            n_t: number of time bins in a trial 
+            gmm: an instance of sklearn's Gaussian mixture model object
+            device: the device (CPU or GPU) on which models are allocated
+            prune_tol, n_neighbors: see BaseADVI
+        """
+        
+        super().__init__(n_t, gmm, device, prune_tol, n_neighbors)
+        self.n_folds = n_folds
+        
+        # drawn in the same order as constructing the ADVI models one by one
+        shapes = {
+            "b_mu": (self.n_c), "b_log_sig": (self.n_c), 
+            "beta_mu": (self.n_c, self.n_t), "beta_log_sig": (self.n_c, self.n_t)
+        }
+        fold_params = {name: [] for name in shapes}
+        for _ in range(n_folds):
+            for name, shape in shapes.items():
+                fold_params[name].append(torch.randn(shape))
+        
+        # one parameter per fold so that folds without data in a step get no update
+        for name in shapes:
+            setattr(self, name, torch.nn.ParameterList(
+                [torch.nn.Parameter(x) for x in fold_params[name]]
+            ))
+            
+            
+    def fold_posterior_params(self, fold):
+        """Posterior parameters of a fold (same format as a trained ADVI model)."""
+        
+        return {
+            "b": self.b_mu[fold].detach().cpu().numpy(),
+            "beta": self.beta_mu[fold].detach().cpu().numpy(),
+            "means": self.means.detach().cpu().numpy(),
+            "covs": self.covs.detach().cpu().numpy(),
+            "components": self.components,
+        }
+    
+    
+    def compute_elbo(
+        self, 
+        spike_ll, 
+        pair_idxs, 
+        time_idxs, 
+        model_params, 
+        scaling_factors,
+        fast_compute=True
+    ):
+        """
+        Compute the ELBO of every active fold.
+        
+        Args:
+            spike_ll: size (n_b, n_c) tensor or SparseLogProb; component log-densities 
+                      of the batch spikes
+            pair_idxs: size (n_b,) tensor; (fold, trial) pair of each spike (see forward)
+            time_idxs: size (n_b,) tensor 
+            model_params: a dict of model parameters returned by forward
+            scaling_factors: size (n_a,) tensor; ELBO scaling factor of each active fold
+            fast_compute: whether to gather the mixing proportions of all spikes at once 
+                          (otherwise loop over each pair and time bin)
+            
+        Returns:
+            elbos: size (n_a,) tensor; ELBO of each active fold
+        """
+        
+        log_pis, pair_folds = model_params["log_pi"], model_params["pair_folds"]
+        b_sample, beta_sample = model_params["b"], model_params["beta"]
+        n_samples = b_sample.shape[:-2].numel()
+        
+        lp = D.Normal(0., 1.).log_prob(b_sample).sum(-1) \
+             + D.Normal(0., 1.).log_prob(beta_sample).sum((-2,-1))
+        lq = self.b.log_prob(b_sample).sum(-1) + self.beta.log_prob(beta_sample).sum((-2,-1))
+        
+        if fast_compute:
+            spike_elbos = _log_mixture_density(spike_ll, log_pis, pair_idxs, time_idxs.long())
+        else:
+            spike_elbos = torch.zeros(
+                log_pis.shape[:-3] + (len(spike_ll),), dtype=log_pis.dtype, device=log_pis.device
+            )
+            for p in range(log_pis.shape[-3]):
+                for t in range(self.n_t):
+                    pair_time_idx = torch.logical_and(pair_idxs == p, time_idxs == t)
+                    sub_spike_ll = spike_ll[pair_time_idx]
+                    if len(sub_spike_ll) > 0:
+                        sub_idxs = torch.zeros(len(sub_spike_ll), dtype=torch.long, device=time_idxs.device)
+                        spike_elbos[..., pair_time_idx] = _log_mixture_density(
+                            sub_spike_ll, log_pis, sub_idxs + p, sub_idxs + t
+                        )
+        spike_elbos = spike_elbos * scaling_factors[pair_folds[pair_idxs]]
+        lik = torch.zeros(lp.shape, dtype=spike_elbos.dtype, device=spike_elbos.device)
+        lik.index_add_(-1, pair_folds[pair_idxs], spike_elbos)
+        
+        # average over the MC samples
+        elbos = (lp - lq + lik).reshape(-1, lp.shape[-1]).sum(0) / n_samples
+        
+        return elbos
+    
+    
+    def forward(self, behaviors, pair_folds, folds, n_mc_samples=1):
+        """
+        Performs forward pass computation for a set of (fold, trial) pairs.
+        
+        Args:
+            behaviors: size (n_p,) or (n_p, n_t) tensor; behavior of each pair
+            pair_folds: size (n_p,) tensor; position in `folds` of the fold of each pair
+            folds: list of the active folds
+            n_mc_samples: number of MC samples of b and beta drawn in one batch
+            
+        Returns:
+            model_params: a dict of model parameters that contains b, beta (size (n_a, ...)), 
+                          pi, log_pi, lambda (size (n_p, n_c, n_t)) and pair_folds
+                          (w/ a leading dim of size n_mc_samples if n_mc_samples > 1)
+        """
+        
+        # define variational variables
+        self.b = D.Normal(
+            torch.stack([self.b_mu[f] for f in folds]), 
+            torch.stack([self.b_log_sig[f] for f in folds]).exp()
+        )
+        self.beta = D.Normal(
+            torch.stack([self.beta_mu[f] for f in folds]), 
+            torch.stack([self.beta_log_sig[f] for f in folds]).exp()
+        )
+        
+        # sample from variational distributions
+        sample_shape = torch.Size([n_mc_samples]) if n_mc_samples > 1 else torch.Size()
+        b_sample = self.b.rsample(sample_shape)
+        beta_sample = self.beta.rsample(sample_shape)
+        
+        # compute mixing proportions 
+        log_lambdas = (
+            b_sample[...,pair_folds,:,None] + beta_sample[...,pair_folds,:,:] * behaviors[:,None,:]
+        )
+        log_pis = log_lambdas - torch.logsumexp(log_lambdas, -2)[...,None,:]
+        
+        model_params = {
+            "pi": log_pis.exp(), 
+            "log_pi": log_pis, 
+            "b": b_sample, 
+            "beta": beta_sample, 
+            "lambda": log_lambdas.exp(),
+            "pair_folds": pair_folds
+        }
+        
+        return model_params
+    
+    
+def _log_mixture_density(spike_ll, log_pis, pair_idxs, time_idxs):
+    """
+    Log-density of each spike under the mixture of its trial and time bin.
+    
+    Args:
+        spike_ll: size (n_b, n_c) tensor or SparseLogProb; component log-densities
+        log_pis: size (..., n_p, n_c, n_t) tensor; log mixing proportions
+        pair_idxs: size (n_b,) tensor; index of the trial of each spike in n_p
+        time_idxs: size (n_b,) tensor 
+        
+    Returns:
+        log_density: size (..., n_b) tensor
+    """
+    
+    log_pis = log_pis.transpose(-1,-2)
+    if isinstance(spike_ll, SparseLogProb):
+        # gather the mixing proportion of each stored entry only
+        rows = spike_ll.rows
+        log_mixing_props = log_pis[..., pair_idxs[rows], time_idxs[rows], spike_ll.indices]
+        return csr_logsumexp(spike_ll.values + log_mixing_props, rows, len(spike_ll))
+    
+    return torch.logsumexp(spike_ll + log_pis[..., pair_idxs, time_idxs, :], -1)
+    
+    
 def train_advi(
     model, 
     spike_features, 
@@ -229,10 +484,14 @@ def train_advi(
     optim, 
     max_iter=1000,
     fast_compute=True,
-    stochastic=True
+    stochastic=True,
+    n_mc_samples=1,
+    monitor=None
 ):
     """
-    Trains the ADVI model on the provided dataset.
+    Trains the ADVI model on the provided dataset. The component log-densities of 
+    the spikes are computed once before training if they fit in memory (see 
+    BaseADVI.precompute_log_likelihood).
     
     Args:
         spike_features: size (N, n_d) tensor,
@@ -244,7 +503,14 @@ def train_advi(
         batch_idxs: trial index allocated to each batch
         optim: pytorch optimizer to update the gradients 
         max_iter: maximum number of iterations  
-        fast_compute: whether to speed up the computation (only when batch_size = 1)
+        fast_compute: whether to use the vectorized ELBO computation
+        stochastic: whether to update on one random batch per iteration 
+                    (otherwise on every batch)
+        n_mc_samples: number of MC samples used to estimate the ELBO (and its gradient)
+                      at each step
+        monitor: a ConvergenceMonitor to stop before max_iter (runs max_iter 
+                 iterations if None); model.n_iter_ is set to the number of 
+                 iterations run
         
     Returns:
         elbos: a list containing the computed ELBO
@@ -253,7 +519,12 @@ def train_advi(
     assert max_iter > 5, "need more iterations to train the model."
     N = len(torch.unique(trial_idxs))
     n_batches, batch_size = len(batch_idxs), len(batch_idxs[0])
-    fast_compute = False if batch_size > 1 else True
+    
+    # component log-densities are computed once and sliced for every batch
+    spike_ll = model.precompute_log_likelihood(spike_features)
+    batch_spike_idxs, batch_trials = _index_batches(trial_idxs, batch_idxs)
+    monitor = ConvergenceMonitor() if monitor is None else monitor
+    monitor.reset()
     
     elbos = []
     for it in tqdm(range(max_iter), desc="Train ADVI"):
@@ -261,15 +532,15 @@ def train_advi(
         if stochastic:
             
             idx = np.random.choice(range(n_batches), 1).item()
-            batch_idx = batch_idxs[idx]
-            mask = np.sum([trial_idxs[0] == idx for idx in batch_idx], axis=0)
+            mask = batch_spike_idxs[idx]
 
             batch_spike_features = spike_features[mask]
-            batch_behaviors = behaviors[list(batch_idx)]
+            batch_spike_ll = None if spike_ll is None else spike_ll[mask]
+            batch_behaviors = behaviors[batch_trials[idx]]
             batch_trial_idxs = trial_idxs[mask]
             batch_time_idxs = time_idxs[mask]
 
-            model_params = model(batch_behaviors)
+            model_params = model(batch_behaviors, n_mc_samples)
 
             loss = - model.compute_elbo(
                 batch_spike_features, 
@@ -277,7 +548,8 @@ def train_advi(
                 batch_time_idxs, 
                 model_params, 
                 scaling_factor=batch_size/N,
-                fast_compute=fast_compute
+                fast_compute=fast_compute,
+                spike_ll=batch_spike_ll
             )
             loss.backward()
             elbo = - loss.item()
@@ -288,16 +560,17 @@ def train_advi(
         else:
             
             tot_elbo = 0
-            for idx, batch_idx in enumerate(batch_idxs): 
+            for idx in range(n_batches): 
                 
-                mask = np.sum([trial_idxs[0] == idx for idx in batch_idx], axis=0)
+                mask = batch_spike_idxs[idx]
                 
                 batch_spike_features = spike_features[mask]
-                batch_behaviors = behaviors[list(batch_idx)]
+                batch_spike_ll = None if spike_ll is None else spike_ll[mask]
+                batch_behaviors = behaviors[batch_trials[idx]]
                 batch_trial_idxs = trial_idxs[mask]
                 batch_time_idxs = time_idxs[mask]
                 
-                model_params = model(batch_behaviors)
+                model_params = model(batch_behaviors, n_mc_samples)
                 
                 loss = - model.compute_elbo(
                     batch_spike_features, 
@@ -305,7 +578,8 @@ def train_advi(
                     batch_time_idxs, 
                     model_params, 
                     scaling_factor=batch_size/N,
-                    fast_compute=fast_compute
+                    fast_compute=fast_compute,
+                    spike_ll=batch_spike_ll
                 )
                 
                 loss.backward()
@@ -313,12 +587,206 @@ def train_advi(
                 optim.step()
                 optim.zero_grad()
             elbos.append(tot_elbo)
+            
+        if monitor.should_evaluate(it, max_iter) and monitor.update(it, elbos[-1]):
+            break
+    model.n_iter_ = monitor.n_iter_
         
     elbos = [elbo for elbo in elbos]
     
     return elbos
 
 
+def _index_batches(trial_idxs, batch_idxs):
+    """
+    Group the spikes by trial once so that each batch is a set of contiguous slices.
+    
+    Args:
+        trial_idxs: size (N,) tensor 
+        batch_idxs: trial index allocated to each batch
+        
+    Returns:
+        batch_spike_idxs: a list of size (n_b,) tensors; spikes in each batch 
+                          (sorted by trial)
+        batch_trials: a list of trials in each batch that contain spikes (sorted, 
+                      which is the local trial order used by ADVI.compute_elbo)
+    """
+    
+    device = trial_idxs.device
+    order, unique_trials, offsets = group_by_key(trial_idxs.cpu().numpy())
+    
+    batch_spike_idxs, batch_trials = [], []
+    for batch_idx in batch_idxs:
+        trials = np.intersect1d(batch_idx, unique_trials).astype(int)
+        slots = np.searchsorted(unique_trials, trials)
+        spike_idxs, _ = concat_ranges(offsets[slots], offsets[slots+1])
+        batch_spike_idxs.append(torch.as_tensor(order[spike_idxs]).to(device))
+        batch_trials.append(trials.tolist())
+        
+    return batch_spike_idxs, batch_trials
+
+
+def train_fold_advi(
+    model, 
+    spike_features, 
+    behaviors, 
+    trial_idxs, 
+    time_idxs, 
+    fold_batch_idxs, 
+    optim, 
+    max_iter=1000,
+    fast_compute=True,
+    stochastic=True,
+    n_mc_samples=1,
+    monitor=None
+):
+    """
+    Trains the ADVI models of all folds jointly in one vectorized forward / backward 
+    pass per step. Since the ELBOs of the folds do not share parameters, this is 
+    equivalent to running train_advi for each fold.
+    
+    Args:
+        model: a FoldADVI model
+        spike_features: size (N, n_d) tensor,
+                        N = number of spikes in all trials (only the spikes in 
+                            the train set of some fold are evaluated)
+                        n_d = spike feature dim
+        behaviors: size (n_k,) or (n_k, n_t) tensor 
+        trial_idxs: size (N,) tensor 
+        time_idxs: size (N,) tensor 
+        fold_batch_idxs: a list of batch_idxs (train trial index allocated to each 
+                         batch) for each fold
+        optim: pytorch optimizer to update the gradients (must skip parameters 
+               without gradients, as all pytorch optimizers do)
+        max_iter: maximum number of iterations  
+        fast_compute: whether to use the vectorized ELBO computation
+        stochastic: whether to update on one random batch per iteration 
+                    (otherwise on every batch)
+        n_mc_samples: number of MC samples used to estimate the ELBO (and its gradient)
+                      at each step
+        monitor: a ConvergenceMonitor that is copied for each fold and applied to the 
+                 fold's own ELBO (runs max_iter iterations if None); a converged fold 
+                 is no longer updated, so each fold stops where train_advi would; 
+                 model.n_iter_ is set to a size (n_folds,) array of the number of 
+                 iterations run by each fold
+        
+    Returns:
+        elbos: a list containing the computed ELBO, size (n_folds,) array per iteration
+               (NaN for the folds that have already converged)
+    """
+    
+    assert max_iter > 5, "need more iterations to train the model."
+    n_folds = len(fold_batch_idxs)
+    device = spike_features.device
+    
+    # for each fold and batch: spikes, their local trial slot and the batch trials
+    fold_batches, scaling_factors = [], []
+    for batch_idxs in fold_batch_idxs:
+        batch_spike_idxs, batch_trials = _index_batches(trial_idxs, batch_idxs)
+        batches = []
+        for spike_idxs, trials in zip(batch_spike_idxs, batch_trials):
+            local_trial_idxs = torch.searchsorted(
+                torch.as_tensor(trials, dtype=trial_idxs.dtype, device=device), 
+                trial_idxs[spike_idxs]
+            )
+            batches.append((spike_idxs, local_trial_idxs, trials))
+        fold_batches.append(batches)
+        n_trials = len(set(trial for trials in batch_trials for trial in trials))
+        scaling_factors.append(len(batch_idxs[0]) / n_trials)
+    scaling_factors = torch.tensor(scaling_factors, device=device)
+    
+    # only the spikes in the train set of some fold are used; the batches index them
+    train_spikes = torch.unique(torch.cat(
+        [spike_idxs for batches in fold_batches for spike_idxs, _, _ in batches]
+    ))
+    spike_features, time_idxs = spike_features[train_spikes], time_idxs[train_spikes]
+    fold_batches = [
+        [(torch.searchsorted(train_spikes, spike_idxs), *batch) 
+         for spike_idxs, *batch in batches] 
+        for batches in fold_batches
+    ]
+    
+    # component log-densities are computed once and shared by all folds
+    spike_ll = model.precompute_log_likelihood(spike_features)
+    
+    # each fold has its own monitor, as if it was trained alone
+    monitor = ConvergenceMonitor() if monitor is None else monitor
+    monitors = [copy.deepcopy(monitor) for _ in range(n_folds)]
+    for fold_monitor in monitors:
+        fold_monitor.reset()
+    active = list(range(n_folds))
+    
+    def step(fold_batch):
+        """One update on a batch of each fold in fold_batch (fold -> batch index)."""
+        
+        folds = sorted(fold_batch)
+        spike_idxs, pair_idxs, trials, pair_folds = [], [], [], []
+        for i, f in enumerate(folds):
+            batch_spike_idxs, local_trial_idxs, batch_trials = fold_batches[f][fold_batch[f]]
+            spike_idxs.append(batch_spike_idxs)
+            pair_idxs.append(local_trial_idxs + len(trials))
+            trials.extend(batch_trials)
+            pair_folds.extend([i] * len(batch_trials))
+        spike_idxs, pair_idxs = torch.cat(spike_idxs), torch.cat(pair_idxs)
+        
+        model_params = model(
+            behaviors[trials], torch.tensor(pair_folds, device=device), folds, n_mc_samples
+        )
+        if spike_ll is None:
+            batch_spike_ll = model.compute_log_likelihood(spike_features[spike_idxs])
+        else:
+            batch_spike_ll = spike_ll[spike_idxs]
+        elbos = model.compute_elbo(
+            batch_spike_ll, 
+            pair_idxs, 
+            time_idxs[spike_idxs], 
+            model_params, 
+            scaling_factors[folds],
+            fast_compute=fast_compute
+        )
+        loss = - elbos.sum()
+        loss.backward()
+        optim.step()
+        optim.zero_grad(set_to_none=True)
+        
+        fold_elbos = np.zeros(n_folds)
+        fold_elbos[folds] = elbos.detach().cpu().numpy()
+        
+        return fold_elbos
+    
+    elbos = []
+    for it in tqdm(range(max_iter), desc="Train ADVI (folds)"):
+        
+        if stochastic:
+            fold_batch = {
+                f: np.random.choice(range(len(fold_batches[f])), 1).item() 
+                for f in active
+            }
+            iter_elbos = step(fold_batch)
+            
+        else:
+            iter_elbos = np.zeros(n_folds)
+            for idx in range(max(len(fold_batches[f]) for f in active)):
+                # folds w/ fewer batches sit out the last steps
+                iter_elbos += step({
+                    f: idx for f in active if idx < len(fold_batches[f])
+                })
+        
+        # converged folds are no longer updated (their parameters get no gradient)
+        iter_elbos[[f for f in range(n_folds) if f not in active]] = np.nan
+        elbos.append(iter_elbos)
+        active = [
+            f for f in active if not (
+                monitors[f].should_evaluate(it, max_iter) and monitors[f].update(it, iter_elbos[f])
+            )
+        ]
+        if len(active) == 0:
+            break
+    model.n_iter_ = np.array([fold_monitor.n_iter_ for fold_monitor in monitors])
+    
+    return elbos
+
+
 def compute_posterior_weight_matrix(
     x, 
     y_train, 
@@ -326,14 +794,15 @@ def compute_posterior_weight_matrix(
     train, 
     test, 
     post_params,
-    n_workers=4
+    n_workers=4,
+    pool=None
 ):
     """
     Compute the posterior dynamic mixture weights for GMM and the posterior weight matrix 
     as input to the behavior decoder. (Parallel computing enabled)
 
     Args:
-        x: a nested list w/ the structure:
+        x: a BinnedSpikes container or a nested list w/ the structure:
            for each k:
                for each t:
                    size (n_t_k, 1+n_d) array, n_d = spike feature dim
@@ -341,7 +810,10 @@ def compute_posterior_weight_matrix(
         train: trial index in the train set
         test: trial index in the test set
         post_params: a dict of model parameters that contains b, beta, means and covs 
+                     (and optionally the GaussianComponentBank of means and covs, 
+                     whose pruning settings are then used)
         n_workers: number of workers in multiprocessing
+        pool: a WorkerPool to reuse (the process-wide pool w/ n_workers if None)
 
     Returns:
         mixture_weights: size (n_k, n_c, n_t) array
@@ -353,82 +825,152 @@ def compute_posterior_weight_matrix(
         y = np.hstack([y_train, y_pred])
     else:
         y = np.vstack([y_train, y_pred])
-    x = [x[idx] for idx in align_idxs]
+    x = as_binned_spikes(x)
     
     n_k = len(y)
     n_c, n_t = post_params["beta"].shape
     
-    match_idxs = [np.argwhere(np.array(align_idxs)==k).item() for k in range(n_k)]
-        
-    if n_workers == 1:
+    # work in trial order: position of each trial k in align_idxs
+    match_idxs = np.argsort(align_idxs)
+    y = y[match_idxs]
+    log_pis = _compute_posterior_log_pis(post_params, y)
+    mixture_weights = np.exp(log_pis)
         
-        log_lambdas = np.zeros((n_k, n_c, n_t))
-        log_lambdas = (
-            post_params["b"][:,None,None] + post_params["beta"][:,:,None] * y.T
-        ).transpose((-1,0,1))
-        log_pis = log_lambdas - logsumexp(log_lambdas, 1)[:,None,:]
-        mixture_weights = np.exp(log_pis)
-
-        weight_matrix = np.zeros((n_k, n_c, n_t))
-        for k in tqdm(range(n_k), desc="Compute weight matrix"):
-            for t in range(n_t):
-                post_gmm = GaussianMixture(n_components=n_c, covariance_type='full')
-                post_gmm.weights_ = mixture_weights[k,:,t]
-                post_gmm.means_ = post_params["means"]
-                post_gmm.covariances_ = post_params["covs"]
-                post_gmm.precisions_cholesky_ = np.linalg.cholesky(
-                    np.linalg.inv(post_params["covs"])
-                )
-                if len(x[k][t]) > 0:
-                    weight_matrix[k,:,t] = post_gmm.predict_proba(x[k][t][:,1:]).sum(0)
-    else:
+    spike_features, trial_idxs, time_idxs = x.select_trials(align_idxs)
+    components = GaussianComponentBank.from_params(post_params)
+    
+    if n_workers == 1 and pool is None:
         
-        pool = multiprocessing.Pool(processes=n_workers)
+        weight_matrix = _compute_posterior_weights(
+            spike_features[:,1:], trial_idxs * n_t + time_idxs, log_pis, components
+        )
         
-        results = [pool.apply_async(
-                    compute_weight_single_process, 
-                    args=(x[k], y[k], post_params)
-                    ) for k in range(n_k)]
-        outputs = [result.get() for result in results]
+    else:
         
-        pool.close()
-        pool.join()
-    
-        mixture_weights, weight_matrix = [], []
-        for _, out in enumerate(outputs):
-            mixture_weights.append(out[0])
-            weight_matrix.append(out[1])
-        mixture_weights, weight_matrix = np.vstack(mixture_weights), np.vstack(weight_matrix) 
-          
-    mixture_weights, weight_matrix = mixture_weights[match_idxs], weight_matrix[match_idxs]
+        pool = get_worker_pool(n_workers) if pool is None else pool
+        
+        # workers read the inputs from and write the outputs to shared memory; 
+        # each task is a range of trials w/ a similar number of spikes
+        trial_offsets = np.searchsorted(trial_idxs, np.arange(n_k + 1))
+        shared = [pool.share(arr) for arr in [
+            spike_features[:,1:], time_idxs, trial_offsets, log_pis, components.means.cpu(), 
+            components.prec_chol.cpu(), components.log_det.cpu(), np.zeros((n_k, n_c, n_t))
+        ]]
+        try:
+            pool.map_ranges(
+                _compute_weight_chunk, n_k, 
+                args=(*shared, components.prune_tol, components.n_neighbors), 
+                weights=np.diff(trial_offsets)
+            )
+            weight_matrix = shared[-1].array.copy()
+        finally:
+            pool.release(*shared)
 
     return mixture_weights, weight_matrix
 
 
 def compute_weight_single_process(x, y, post_params):
     """
-    Compute the posterior weight matrix for parallel computing.
+    Compute the posterior weight matrix of a single trial.
+    
+    Args:
+        x: a list of size (n_t_k, 1+n_d) arrays (spikes in each time bin of a trial)
+        y: float or size (n_t,) array
+        post_params: a dict of model parameters that contains b, beta, means and covs 
+        
+    Returns:
+        mixture_weights: size (1, n_c, n_t) array
+        weight_matrix: size (1, n_c, n_t) array
     """
     
     y = y.reshape(1,-1)
-    n_c, n_t = post_params["beta"].shape
+    n_t = post_params["beta"].shape[1]
     
-    log_lambdas = np.zeros((1, n_c, n_t))
-    log_lambdas = (post_params["b"][:,None,None] + \
-                   post_params["beta"][:,:,None] * y.T).transpose((-1,0,1))
-    log_pis = log_lambdas - logsumexp(log_lambdas, 1)[:,None,:]
+    log_pis = _compute_posterior_log_pis(post_params, y)
     mixture_weights = np.exp(log_pis)
-
-    weight_matrix = np.zeros((1, n_c, n_t))
-    for t in range(n_t):
-        post_gmm = GaussianMixture(n_components=n_c, covariance_type='full')
-        post_gmm.weights_ = mixture_weights[:,:,t]
-        post_gmm.means_ = post_params["means"]
-        post_gmm.covariances_ = post_params["covs"]
-        post_gmm.precisions_cholesky_ = np.linalg.cholesky(
-            np.linalg.inv(post_params["covs"])
-        )
-        if len(x[t]) > 0:
-            weight_matrix[:,:,t] = post_gmm.predict_proba(x[t][:,1:]).sum(0)
+    
+    time_idxs = np.repeat(np.arange(n_t), [len(x_t) for x_t in x])
+    weight_matrix = _compute_posterior_weights(
+        np.concatenate(x)[:,1:], time_idxs, log_pis, GaussianComponentBank.from_params(post_params)
+    )
                 
     return mixture_weights, weight_matrix
+
+
+def _compute_weight_chunk(
+    start, 
+    end, 
+    spike_features, 
+    time_idxs, 
+    trial_offsets, 
+    log_pis, 
+    means, 
+    prec_chol, 
+    log_det, 
+    weight_matrix,
+    prune_tol=None,
+    n_neighbors=None
+):
+    """
+    Compute the posterior weight matrix of trials [start, end) in a worker 
+    (all array arguments are SharedArray objects).
+    """
+    
+    n_t = log_pis.shape[2]
+    trial_offsets = trial_offsets.array
+    lo, hi = trial_offsets[start], trial_offsets[end]
+    trial_idxs = np.repeat(np.arange(end - start), np.diff(trial_offsets[start:end+1]))
+    
+    weight_matrix.array[start:end] = _compute_posterior_weights(
+        spike_features.array[lo:hi], 
+        trial_idxs * n_t + time_idxs.array[lo:hi], 
+        log_pis.array[start:end], 
+        GaussianComponentBank.from_factors(
+            means.array, prec_chol.array, log_det.array, prune_tol, n_neighbors
+        )
+    )
+
+
+def _compute_posterior_log_pis(post_params, y):
+    """
+    Compute the log posterior mixture weights.
+    
+    Args:
+        post_params: a dict of model parameters that contains b and beta 
+        y: size (n_k, 1) or (n_k, n_t) array
+        
+    Returns:
+        log_pis: size (n_k, n_c, n_t) array
+    """
+    
+    log_lambdas = (
+        post_params["b"][:,None,None] + post_params["beta"][:,:,None] * y.T
+    ).transpose((-1,0,1))
+    log_pis = log_lambdas - logsumexp(log_lambdas, 1)[:,None,:]
+    
+    return log_pis
+
+
+def _compute_posterior_weights(spike_features, segment_idxs, log_pis, components):
+    """
+    Sum the posterior responsibilities of the spikes in each (trial, time bin)
+    w/ one component log-density pass over all spikes.
+    
+    Args:
+        spike_features: size (N, n_d) array
+        segment_idxs: size (N,) array; trial index * n_t + time bin index of each spike
+        log_pis: size (n_k, n_c, n_t) array
+        components: a GaussianComponentBank
+        
+    Returns:
+        weight_matrix: size (n_k, n_c, n_t) array
+    """
+    
+    n_k, n_c, n_t = log_pis.shape
+    weight_matrix = components.responsibility_sums(
+        spike_features, 
+        segment_idxs, 
+        log_pis.transpose(0,2,1).reshape(n_k * n_t, n_c)
+    )
+    
+    return weight_matrix.cpu().numpy().reshape(n_k, n_t, n_c).transpose(0,2,1)
@@ -1,10 +1,10 @@
 import numpy as np
 from tqdm import tqdm
 import torch
-from scipy.stats import multivariate_normal
-from sklearn.mixture import GaussianMixture
 from sklearn.metrics import accuracy_score, roc_auc_score
-from density_decoding.utils.utils import safe_log, safe_divide
+from density_decoding.utils.utils import safe_log, safe_divide, ConvergenceMonitor
+from density_decoding.utils.binning import as_binned_spikes
+from density_decoding.models.gaussian import GaussianComponentBank
 
 class CAVI():
     def __init__(
@@ -46,43 +46,42 @@ class CAVI():
         self.test_ks = test_trial_idxs
         self.test_ts = test_time_idxs
         
+        # per-spike time bin (and test trial) index for gathering parameters
+        self.train_t = self._invert_index(train_time_idxs)
+        self.test_t = self._invert_index(test_time_idxs)
+        self.test_k = self._invert_index(test_trial_idxs)
         
-    def _compute_gmm_log_pdf(self, s, mu, cov, safe_cov=None):
+        
+    @staticmethod
+    def _invert_index(idxs):
+        """
+        Convert a list of arrays, where idxs[i] contains the spikes of group i, 
+        into a size (N,) tensor that contains the group of each spike.
+        """
+        
+        n_spikes = sum(len(idx) for idx in idxs)
+        groups = torch.zeros(n_spikes, dtype=torch.long)
+        for i, idx in enumerate(idxs):
+            groups[torch.as_tensor(idx, dtype=torch.long)] = i
+            
+        return groups
+    
+    
+    def _gather_log_lam(self, norm_lam, time_idx):
         """
-        Compute the log-likelihood of the mixture model. 
+        Gather the normalized lambda of each spike's time bin.
         
         Args:
-            s: size (N, n_d) array, N = number of spikes, n_d = spike feature dim
-            mu: size (n_c, n_d) array (updated mixture means)
-            cov: size (n_c, n_d, n_d) array (updated mixture covariance matrix)
-            safe_cov: size (n_c, n_d, n_d) array
-                      (alternative covariance matrix to use in case cov is non-PSD)
-         
+            norm_lam: size (n_c, n_t, n_p) array (normalized lambda)
+            time_idx: size (N,) tensor (time bin index of each spike)
+            
         Returns:
-            ll: size (N, n_c) array; computed log-likelihood 
+            lam0, lam1: size (N, n_c) arrays; normalized lambda for y = 0 and y = 1
         """
         
-        ll = []
-        for c in range(self.n_c):
-            try:
-                ll.append(
-                    torch.tensor(
-                        multivariate_normal.logpdf(s, mu[c], cov[c])
-                    )
-                )
-            except np.linalg.LinAlgError:
-                # TO DO: Need a better solution. 
-                # This error occurs when the covariance matrix is not PSD.
-                # We can use the initial covariance matrix as a replacement to ensure numerical stability.
-                ll.append(
-                    torch.tensor(
-                        multivariate_normal.logpdf(s, mu[c], safe_cov[c])
-                    )
-                )
-                
-        return torch.vstack(ll).T 
-    
-    
+        return norm_lam[:, time_idx, 0].T, norm_lam[:, time_idx, 1].T
+        
+        
     def _compute_encoder_elbo(self, r, y, ll, norm_lam):
         """
         Compute the ELBO for the encoder model.
@@ -97,18 +96,10 @@ class CAVI():
             elbo: float; ELBO
         """
         
-        elbo = torch.sum(torch.tensor(
-            [torch.einsum('i,i->', r[:,c], ll[:,c]) for c in range(self.n_c)]
-        ))
+        lam0, lam1 = self._gather_log_lam(norm_lam, self.train_t)
         
-        elbo += torch.tensor(
-            [ torch.einsum(
-                'ij,il,j->', r[self.train_ts[t]], y[self.train_ts[t]], norm_lam[:,t,1]
-              ) + \
-              torch.einsum(
-                'ij,il,j->', r[self.train_ts[t]], 1-y[self.train_ts[t]], norm_lam[:,t,0]
-              ) for t in range(self.n_t) 
-            ]).sum()
+        elbo = torch.sum(r * ll)
+        elbo += torch.sum(r * (y * lam1 + (1-y) * lam0))
         
         elbo -= torch.einsum('ij,ij->', safe_log(r), r)
         
@@ -131,18 +122,10 @@ class CAVI():
             elbo: float; ELBO
         """
         
-        elbo = torch.sum(torch.tensor(
-            [torch.einsum('i,i->', r[:,c], ll[:,c]) for c in range(self.n_c)]
-        ))
+        lam0, lam1 = self._gather_log_lam(norm_lam, self.test_t)
         
-        elbo += torch.tensor(
-            [ torch.einsum(
-                'ij,il,j->', r[self.test_ts[t]], nu[self.test_ts[t]], norm_lam[:,t,1]
-              ) + \
-              torch.einsum(
-                'ij,il,j->', r[self.test_ts[t]], 1-nu[self.test_ts[t]], norm_lam[:,t,0]
-              ) for t in range(self.n_t) 
-            ]).sum()
+        elbo = torch.sum(r * ll)
+        elbo += torch.sum(r * (nu * lam1 + (1-nu) * lam0))
         
         elbo += torch.sum(nu_k * safe_log(p) + (1-nu_k) * safe_log(1-p))
         elbo -= torch.einsum('ij,ij->', safe_log(r), r)
@@ -165,19 +148,38 @@ class CAVI():
             r: size (N, n_c) array (updated normalized E_q(z)[z])  
         """
         
-        for t in range(self.n_t):
-            r[self.train_ts[t]] = torch.exp( 
-                  ll[self.train_ts[t]] + \
-                  torch.einsum('il,j->ij', y[self.train_ts[t]], norm_lam[:,t,1]) + \
-                  torch.einsum('il,j->ij', 1-y[self.train_ts[t]], norm_lam[:,t,0])
-            )
-            r[self.train_ts[t]] = torch.einsum(
-                'ij,i->ij', r[self.train_ts[t]], 1/r[self.train_ts[t]].sum(1)
-            )
+        lam0, lam1 = self._gather_log_lam(norm_lam, self.train_t)
+        r = torch.softmax(ll + y * lam1 + (1-y) * lam0, 1)
             
         return r
         
     
+    def _update_gaussians(self, s, r):
+        """
+        Update the means and covariance matrices of all components at once.
+        
+        Args:
+            s: size (N, n_d) array, N = number of spikes, n_d = spike feature dim
+            r: size (N, n_c) array (normalized E_q(z)[z])  
+        
+        Returns:
+            mu: size (n_c, n_d) array (updated GMM means) 
+            cov: size (n_c, n_d, n_d) array (updated GMM covariance matrix)
+        """
+        
+        norm = r.sum(0)
+        mu = torch.einsum('j,ij,ip->jp', 1/norm, r, s)
+        
+        # center the spikes first to limit cancellation in E[ss^T] - mu mu^T
+        center = s.mean(0)
+        s, mu_centered = s - center, mu - center
+        ss = (s[:,:,None] * s[:,None,:]).reshape(-1, self.n_d * self.n_d)
+        cov = (r.T @ ss).reshape(self.n_c, self.n_d, self.n_d) / norm[:,None,None]
+        cov = cov - mu_centered[:,:,None] * mu_centered[:,None,:]
+        
+        return mu, cov
+    
+    
     def _encode_m_step(self, s, r, y, mu, lam):
         """
         Execute the M step of the encoder.
@@ -196,21 +198,24 @@ class CAVI():
             norm_lam: size (n_c, n_t, n_p) array (updated normalized lambda)
         """
         
+        # sum of responsibilities per (time bin, behavior class): size (n_c, n_t, n_p)
+        r_y = torch.stack([
+            torch.zeros((self.n_t, self.n_c), dtype=r.dtype).index_add_(0, self.train_t, r * (1-y).sum(1, keepdim=True)),
+            torch.zeros((self.n_t, self.n_c), dtype=r.dtype).index_add_(0, self.train_t, r * y.sum(1, keepdim=True))
+        ], -1).transpose(0, 1)
+        # sums over all other components come from subtracting each component from the total
+        ratio = r_y / (r_y.sum(0) - r_y)
+        
+        # components are updated in sequence, so each update sees the new lambda of 
+        # the components before it; keep a running total instead of re-summing
+        lam_sum = lam.sum(0)
         for c in range(self.n_c):
-            no_c_idx = torch.cat([torch.arange(c), torch.arange(c+1, self.n_c)])
-            lam_sum_no_c = lam[no_c_idx,:,:].sum(0)
-            for t in range(self.n_t):
-                num1 = torch.einsum('i,il,->', r[self.train_ts[t],c], y[self.train_ts[t]], lam_sum_no_c[t,1])
-                denom1 = np.einsum('ij,il->', r[self.train_ts[t]][:,no_c_idx], y[self.train_ts[t]])
-                num0 = torch.einsum('i,il,->', r[self.train_ts[t],c], 1-y[self.train_ts[t]], lam_sum_no_c[t,0])
-                denom0 = np.einsum('ij,il->', r[self.train_ts[t]][:,no_c_idx], 1-y[self.train_ts[t]])
-                lam[c,t,1], lam[c,t,0] = num1 / denom1, num0 / denom0
+            lam_c = ratio[c] * (lam_sum - lam[c])
+            lam_sum += lam_c - lam[c]
+            lam[c] = lam_c
                 
         norm_lam = safe_log(lam) - safe_log(lam.sum(0))
-        norm = r.sum(0)
-        mu = torch.einsum('j,ij,ip->jp', 1/norm, r, s)
-        cov = [torch.einsum(
-                    ',i,ip,id->pd', 1/norm[c], r[:,c], s-mu[c], s-mu[c]) for c in range(self.n_c)]
+        mu, cov = self._update_gaussians(s, r)
         
         return mu, cov, lam, norm_lam
     
@@ -233,28 +238,20 @@ class CAVI():
             nu_k: size (n_k,) array (updated E_q(y)[y])
         """
         
-        for t in range(self.n_t):
-            r[self.test_ts[t]] = torch.exp( ll[self.test_ts[t]] + \
-                      torch.einsum('il,j->ij', nu[self.test_ts[t]], norm_lam[:,t,1]) + \
-                      torch.einsum('il,j->ij', 1-nu[self.test_ts[t]], norm_lam[:,t,0])
-            )
-            r[self.test_ts[t]] = torch.einsum(
-                'ij,i->ij', r[self.test_ts[t]], 1/r[self.test_ts[t]].sum(1)
-            )
-            
-        for k in range(self.test_n_k):
-            y_tilde0, y_tilde1 = safe_log(1-p), safe_log(p)
-            for t in range(self.n_t):
-                k_t_idx = np.intersect1d(self.test_ks[k], self.test_ts[t])
-                y_tilde0 += torch.einsum('ij,j->', r[k_t_idx], norm_lam[:,t,0])
-                y_tilde1 += torch.einsum('ij,j->', r[k_t_idx], norm_lam[:,t,1])
+        lam0, lam1 = self._gather_log_lam(norm_lam, self.test_t)
+        r = torch.softmax(ll + nu * lam1 + (1-nu) * lam0, 1)
+        
+        # sum over the spikes of each test trial
+        y_tilde0 = torch.zeros(self.test_n_k, dtype=r.dtype).index_add_(0, self.test_k, (r * lam0).sum(1))
+        y_tilde1 = torch.zeros(self.test_n_k, dtype=r.dtype).index_add_(0, self.test_k, (r * lam1).sum(1))
+        y_tilde0, y_tilde1 = y_tilde0 + safe_log(1-p), y_tilde1 + safe_log(p)
                 
-            # TO DO: Need a better solution. 
-            # exp(y_tilde) explodes to 0 so need to offset to ensure numerical stability.
-            offset = 1. / (torch.min(torch.tensor([y_tilde0, y_tilde1])) / -745.) 
-            y_tilde0, y_tilde1 = torch.exp(y_tilde0 * offset), torch.exp(y_tilde1 * offset)
-            nu_k[k] = safe_divide(y_tilde1, y_tilde0+y_tilde1)
-            nu[self.test_ks[k]] = nu_k[k]
+        # TO DO: Need a better solution. 
+        # exp(y_tilde) explodes to 0 so need to offset to ensure numerical stability.
+        offset = 1. / (torch.minimum(y_tilde0, y_tilde1) / -745.) 
+        y_tilde0, y_tilde1 = torch.exp(y_tilde0 * offset), torch.exp(y_tilde1 * offset)
+        nu_k = safe_divide(y_tilde1, y_tilde0+y_tilde1)
+        nu = nu_k[self.test_k].reshape(-1,1)
             
         return r, nu, nu_k
     
@@ -276,22 +273,22 @@ class CAVI():
         """
         
         p = nu_k.sum() / self.test_n_k
-        norm = r.sum(0)
-        mu = torch.einsum('j,ij,ip->jp', 1/norm, r, s)
-        cov = [torch.einsum(
-                ',i,ip,id->pd', 1/norm[c], r[:,c], s-mu[c], s-mu[c]
-               ) for c in range(self.n_c)]
+        mu, cov = self._update_gaussians(s, r)
         
         return p, mu, cov
     
     
-    def encode(self, s, y, max_iter=20, eps=1e-6):
+    def encode(self, s, y, max_iter=20, eps=1e-6, monitor=None):
         """
         Run the encoder model.
         
         Args:
             s: size (N, n_d) array, N = number of spikes, n_d = spike feature dim
             y: size (N, n_p) array (convenient rep of observed y for einsum)
+            max_iter: maximum number of iterations
+            eps: relative tolerance on the ELBO change to stop early
+            monitor: a ConvergenceMonitor (overrides eps); self.n_iter_ is set to 
+                     the number of iterations run
         
         Returns:
             r: size (N, n_c) array (updated normalized E_q(z)[z]) 
@@ -308,24 +305,37 @@ class CAVI():
         mu, cov = self.init_mu.clone(), self.init_cov.clone()
         norm_lam = safe_log(lam) - safe_log(lam.sum(0))
         
-        ll = self._compute_gmm_log_pdf(s, mu, cov, safe_cov=self.init_cov)
+        monitor = ConvergenceMonitor(rtol=eps) if monitor is None else monitor
+        monitor.reset()
+        
+        # the covariances are factorized once per M step
+        components = GaussianComponentBank(mu, cov, safe_covs=self.init_cov)
+        ll = components.log_prob(s)
         elbo = self._compute_encoder_elbo(r, y, ll, norm_lam)
         elbos = [elbo]
+        monitor.update(-1, elbo)
         
         for i in tqdm(range(max_iter), desc="Train CAVI"):
             # E step
             r = self._encode_e_step(r, y, ll, norm_lam)
             # M step
             mu, cov, lam, norm_lam = self._encode_m_step(s, r, y, mu, lam)
+            components.update(mu, cov)
+            ll = components.log_prob(s)
             # compute elbo
-            ll = self._compute_gmm_log_pdf(s, mu, cov, safe_cov=self.init_cov)
-            elbo = self._compute_encoder_elbo(r, y, ll, norm_lam)
-            elbos.append(elbo)
+            if monitor.should_evaluate(i, max_iter):
+                elbo = self._compute_encoder_elbo(r, y, ll, norm_lam)
+                elbos.append(elbo)
+                if monitor.update(i, elbo):
+                    break
+        self.n_iter_ = monitor.n_iter_
             
-        return r, lam, mu, torch.stack(cov), elbos
+        return r, lam, mu, cov, elbos
     
     
-    def decode(self, s, init_p, init_mu, init_cov, init_lam, test_ks, test_ids, max_iter=20, eps=1e-6):
+    def decode(
+        self, s, init_p, init_mu, init_cov, init_lam, test_ks, test_ids, max_iter=20, eps=1e-6, monitor=None
+    ):
         """
         Run the decoder model.
         
@@ -337,6 +347,10 @@ class CAVI():
             init_lam: size (n_c, n_t, n_p) array (initial unnormalized lambda)
             test_ks: a list of arrays containing spike index 
             test_ids: test trial index
+            max_iter: maximum number of iterations
+            eps: relative tolerance on the ELBO change to stop early
+            monitor: a ConvergenceMonitor (overrides eps); self.n_iter_ is set to 
+                     the number of iterations run
         
         Returns:
             r: size (n, c) array (updated normalized E_q(z)[z])
@@ -360,21 +374,32 @@ class CAVI():
             nu[test_ks == test_ids[k]] = nu_k[k]
         nu = nu.reshape(-1,1)
         
-        ll = self._compute_gmm_log_pdf(s, mu, cov, safe_cov=init_cov)
+        monitor = ConvergenceMonitor(rtol=eps) if monitor is None else monitor
+        monitor.reset()
+        
+        # the covariances are factorized once per M step
+        components = GaussianComponentBank(mu, cov, safe_covs=init_cov)
+        ll = components.log_prob(s)
         elbo = self._compute_decoder_elbo(r, ll, norm_lam, nu, nu_k, p)
         elbos = [elbo]
+        monitor.update(-1, elbo)
         
         for i in tqdm(range(max_iter), desc="Decode CAVI"):
             # E step
             r, nu, nu_k = self._decode_e_step(r, ll, norm_lam, nu, nu_k, p)
             # M step
             p, mu, cov = self._decode_m_step(s, r, nu_k, mu)
+            components.update(mu, cov)
+            ll = components.log_prob(s)
             # compute elbo
-            ll = self._compute_gmm_log_pdf(s, mu, cov, safe_cov=init_cov)
-            elbo = self._compute_decoder_elbo(r, ll, norm_lam, nu, nu_k, p)
-            elbos.append(elbo)
+            if monitor.should_evaluate(i, max_iter):
+                elbo = self._compute_decoder_elbo(r, ll, norm_lam, nu, nu_k, p)
+                elbos.append(elbo)
+                if monitor.update(i, elbo):
+                    break
+        self.n_iter_ = monitor.n_iter_
             
-        return r, nu_k, mu, torch.stack(cov), p, elbos
+        return r, nu_k, mu, cov, p, elbos
     
     
     def eval_perf(self, nu_k, y_test):
@@ -410,7 +435,7 @@ def compute_cavi_weight_matrix(
     as input to the behavior decoder.
 
     Args:
-        x: a nested list w/ the structure:
+        x: a BinnedSpikes container or a nested list w/ the structure:
            for each k:
                for each t:
                    size (n_t_k, 1+n_d) array, n_d = spike feature dim
@@ -418,6 +443,8 @@ def compute_cavi_weight_matrix(
         train: trial index in the train set
         test: trial index in the test set
         post_params: a dict of model parameters that contains b, beta, means and covs 
+                     (and optionally the GaussianComponentBank of means and covs, 
+                     whose pruning settings are then used)
 
     Returns:
         mixture_weights: size (n_k, n_c, n_t) array
@@ -427,28 +454,25 @@ def compute_cavi_weight_matrix(
     align_idxs = np.append(train, test)
     y_train, y_pred = y_train.squeeze(), y_pred.squeeze()
     y = np.hstack([y_train, y_pred]).astype(int)
-    x = [x[idx] for idx in align_idxs]
+    x = as_binned_spikes(x)
     n_k = len(y) 
     n_c, n_t, _ = post_params["lambdas"].shape
     
-    post_gmm = GaussianMixture(n_components=n_c, covariance_type='full')
-    post_gmm.means_ = post_params["means"]
-    post_gmm.covariances_ = post_params["covs"]
-    post_gmm.precisions_cholesky_ = np.linalg.cholesky(
-        np.linalg.inv(post_params["covs"])
-    )
-    
     mixture_weights = post_params["lambdas"] / post_params["lambdas"].sum(0)
     
-    weight_matrix = np.zeros((n_k, n_c, n_t)) 
-    for k in tqdm(range(n_k), desc="Compute weight matrix"):
-        for t in range(n_t):
-            post_gmm.weights_ = mixture_weights[:,t,y[k]]
-            if len(x[k][t]) > 0:
-                weight_matrix[k,:,t] = post_gmm.predict_proba(x[k][t][:,1:]).sum(0)
-                
-    match_idxs = [np.argwhere(np.array(aligned_idxs) == k).item() for k in range(n_k)]
-    weight_matrix = weight_matrix[match_idxs]
+    # work in trial order: position of each trial k in align_idxs
+    match_idxs = np.argsort(align_idxs)
+    y = y[match_idxs]
+    spike_features, trial_idxs, time_idxs = x.select_trials(align_idxs)
+    
+    # mixture weights only depend on (t, y_k), so all spikes share one log-density pass
+    with np.errstate(divide="ignore"):
+        log_weights = np.log(mixture_weights[:,:,y]).transpose(2,1,0).reshape(n_k * n_t, n_c)
+    components = GaussianComponentBank.from_params(post_params)
+    weight_matrix = components.responsibility_sums(
+        spike_features[:,1:], trial_idxs * n_t + time_idxs, log_weights
+    )
+    weight_matrix = weight_matrix.numpy().reshape(n_k, n_t, n_c).transpose(0,2,1)
 
     return mixture_weights, weight_matrix
     
@@ -463,7 +487,7 @@ def compute_lambda_for_cavi(
     Compute lambda from the observed data to initialize CAVI.
 
     Args:
-        bin_spike_features: a nested list w/ the structure:
+        bin_spike_features: a BinnedSpikes container or a nested list w/ the structure:
                             for each k:
                                 for each t:
                                     size (n_t_k, 1+n_d) array, n_d = spike feature dim
@@ -478,30 +502,33 @@ def compute_lambda_for_cavi(
         p: prob. of choosing 0 or 1 for the binary variable
     """
 
+    bin_spike_features = as_binned_spikes(bin_spike_features)
     n_c = gmm.means_.shape[0]
-    n_k = len(bin_spike_features)
-    n_t = len(bin_spike_features[0])
-    
-    lambdas = []
-    for k in tqdm(range(n_k), desc="Initialize variational params"):
-        lambdas_per_trial = []
-        for t in range(n_t):
-            lamdas_per_time_bin = np.zeros((n_c, n_p))
-            spike_features_per_time_bin = bin_spike_features[k][t][:,1:]
-            if len(spike_features_per_time_bin) > 0:
-                spike_labels = gmm.predict(spike_features_per_time_bin)
-                for c in range(n_c):
-                    if bin_behaviors[k] == 0:
-                        lamdas_per_time_bin[c, 0] = np.sum(spike_labels == c)
-                    else:
-                        lamdas_per_time_bin[c, 1] = np.sum(spike_labels == c)
-            lambdas_per_trial.append(lamdas_per_time_bin)
-        lambdas.append(lambdas_per_trial)
+    n_k = bin_spike_features.n_trials
+    n_t = bin_spike_features.n_t_bins
+    
+    # label all spikes in one pass (chunked to bound the memory of predict)
+    spike_features = bin_spike_features.spike_features[:,1:]
+    chunk_size = max(1, 2**22 // n_c)
+    spike_labels = np.concatenate([np.zeros(0, dtype=int)] + [
+        gmm.predict(spike_features[start:start+chunk_size]) 
+        for start in range(0, len(spike_features), chunk_size)
+    ])
+    
+    # (trial, time bin, component) spike counts
+    counts = np.bincount(
+        (bin_spike_features.trial_idxs * n_t + bin_spike_features.time_idxs) * n_c + spike_labels,
+        minlength=n_k * n_t * n_c
+    ).reshape(n_k, n_t, n_c)
+    
+    assert len(bin_behaviors) == n_k, "bin_behaviors must have one entry per trial."
+    is_right = np.asarray(bin_behaviors) != 0
+    lambdas = np.stack([counts[~is_right].sum(0), counts[is_right].sum(0)], -1)
 
     n_left = np.sum(bin_behaviors == 0)
     n_right = np.sum(bin_behaviors == 1)
     p = n_right / (n_right + n_left)
-    lambdas = ( np.array(lambdas).sum(0) / np.array([n_left, n_right]) ).transpose(1,0,2)
+    lambdas = ( lambdas / np.array([n_left, n_right]) ).transpose(1,0,2)
     
     return lambdas, p
     
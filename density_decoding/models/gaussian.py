@@ -0,0 +1,507 @@
+"""Batched Gaussian log-density kernels shared by the mixture models."""
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import KDTree
+
+from density_decoding.utils.linalg import MAX_CLOSED_FORM_DIM, compute_precision_cholesky
+
+
+def _closed_form_log_prob(s, means, prec_chol, const, chunk_size=None):
+    """
+    Same as gaussian_log_prob for n_d <= 3, evaluated as fused elementwise 
+    expressions over (spikes, components): the quadratic form is expanded over
+    the n_d x n_d entries of prec_chol (any square factor, upper- or lower-triangular).
+    """
+
+    n_c, n_d = means.shape
+    if chunk_size is None:
+        chunk_size = max(1, 2**16 // n_c)
+
+    prec_chol = [[prec_chol[:, i, j] for j in range(n_d)] for i in range(n_d)]
+    means = [means[:, i] for i in range(n_d)]
+
+    ll = torch.empty((s.shape[0], n_c), dtype=const.dtype, device=const.device)
+    for start in range(0, s.shape[0], chunk_size):
+        x = s[start:start+chunk_size]
+        diffs = [x[:, i, None] - means[i] for i in range(n_d)]
+        sq_dist = 0
+        for j in range(n_d):
+            y = diffs[0] * prec_chol[0][j]
+            for i in range(1, n_d):
+                y = y + diffs[i] * prec_chol[i][j]
+            sq_dist = sq_dist + y.square()
+        ll[start:start+chunk_size] = const - .5 * sq_dist
+
+    return ll
+
+
+def gaussian_log_prob(s, means, prec_chol, log_det, chunk_size=None):
+    """
+    Evaluate the log-density of every spike under every Gaussian component
+    (w/ the closed-form kernel for n_d <= MAX_CLOSED_FORM_DIM).
+
+    Args:
+        s: size (N, n_d) array or tensor, N = number of spikes, n_d = spike feature dim
+        means: size (n_c, n_d) tensor
+        prec_chol: size (n_c, n_d, n_d) tensor (from compute_precision_cholesky)
+        log_det: size (n_c,) tensor (from compute_precision_cholesky)
+        chunk_size: number of spikes evaluated at a time; by default chosen to keep
+                    the (chunk_size, n_c, n_d) intermediate around 1 MB (cache-friendly)
+
+    Returns:
+        ll: size (N, n_c) tensor; computed log-likelihood
+    """
+
+    s = torch.as_tensor(s).to(prec_chol)
+    means = torch.as_tensor(means).to(prec_chol)
+    n_c, n_d = means.shape
+    const = log_det - .5 * n_d * np.log(2 * np.pi)
+    if n_d <= MAX_CLOSED_FORM_DIM:
+        return _closed_form_log_prob(s, means, prec_chol, const, chunk_size)
+    
+    if chunk_size is None:
+        chunk_size = max(1, 2**17 // (n_c * n_d))
+
+    # one (n_d, n_c * n_d) matrix so that each chunk is a single matmul
+    prec_chol_flat = prec_chol.permute(1, 0, 2).reshape(n_d, n_c * n_d)
+    mu_prec = torch.einsum('cd,cde->ce', means, prec_chol)
+    
+    ll = torch.empty((s.shape[0], n_c), dtype=prec_chol.dtype, device=prec_chol.device)
+    for start in range(0, s.shape[0], chunk_size):
+        y = (s[start:start+chunk_size] @ prec_chol_flat).reshape(-1, n_c, n_d) - mu_prec
+        ll[start:start+chunk_size] = const - .5 * y.square().sum(-1)
+
+    return ll
+
+
+def segment_responsibility_sums(
+    s, 
+    segment_idxs, 
+    log_weights, 
+    means, 
+    prec_chol, 
+    log_det, 
+    chunk_size=None
+):
+    """
+    Sum the posterior responsibilities of the spikes within each segment 
+    (e.g., each (trial, time bin)), where every segment has its own mixture weights.
+    
+    Args:
+        s: size (N, n_d) array or tensor, N = number of spikes, n_d = spike feature dim
+        segment_idxs: size (N,) array; segment index of each spike
+        log_weights: size (n_s, n_c) array; log mixture weights of each segment
+        means: size (n_c, n_d) tensor
+        prec_chol: size (n_c, n_d, n_d) tensor (from compute_precision_cholesky)
+        log_det: size (n_c,) tensor (from compute_precision_cholesky)
+        chunk_size: number of spikes evaluated at a time
+        
+    Returns:
+        resp_sums: size (n_s, n_c) tensor
+    """
+    
+    s = torch.as_tensor(s).to(prec_chol)
+    segment_idxs = torch.as_tensor(segment_idxs, dtype=torch.long)
+    log_weights = torch.as_tensor(log_weights).to(prec_chol.dtype)
+    n_c = log_weights.shape[1]
+    if chunk_size is None:
+        chunk_size = max(1, 2**22 // n_c)
+        
+    resp_sums = torch.zeros(log_weights.shape, dtype=prec_chol.dtype)
+    for start in range(0, s.shape[0], chunk_size):
+        chunk_segment_idxs = segment_idxs[start:start+chunk_size]
+        ll = gaussian_log_prob(s[start:start+chunk_size], means, prec_chol, log_det)
+        resp = torch.softmax(ll + log_weights[chunk_segment_idxs], 1)
+        resp_sums.index_add_(0, chunk_segment_idxs, resp)
+        
+    return resp_sums
+
+
+def _pairwise_log_prob(s, means, prec_chol, log_det, rows, cols, chunk_size=2**16):
+    """
+    Log-density of spike rows[i] under component cols[i] for each (spike, component) pair.
+    
+    Returns:
+        ll: size (n_pairs,) tensor
+    """
+    
+    n_d = means.shape[1]
+    const = log_det - .5 * n_d * np.log(2 * np.pi)
+    
+    ll = torch.empty(len(rows), dtype=prec_chol.dtype, device=prec_chol.device)
+    for start in range(0, len(rows), chunk_size):
+        r, c = rows[start:start+chunk_size], cols[start:start+chunk_size]
+        y = torch.einsum('nd,nde->ne', s[r] - means[c], prec_chol[c])
+        ll[start:start+chunk_size] = const[c] - .5 * y.square().sum(-1)
+        
+    return ll
+
+
+def _csr_rows(indptr):
+    """Row index of each stored entry of a CSR matrix."""
+    return torch.repeat_interleave(
+        torch.arange(len(indptr) - 1, device=indptr.device), indptr[1:] - indptr[:-1]
+    )
+
+
+def csr_logsumexp(values, rows, n_rows):
+    """
+    Log-sum-exp of the stored entries in each row of a CSR matrix.
+    
+    Args:
+        values: size (..., nnz) tensor; stored entries (leading dims, e.g., MC samples, 
+                are kept)
+        rows: size (nnz,) tensor; row index of each entry
+        n_rows: number of rows
+        
+    Returns:
+        lse: size (..., n_rows) tensor (-inf for empty rows)
+    """
+    
+    shape = values.shape[:-1] + (n_rows,)
+    with torch.no_grad():
+        row_max = torch.full(shape, -np.inf, dtype=values.dtype, device=values.device)
+        row_max.scatter_reduce_(-1, rows.expand_as(values), values, reduce="amax")
+        row_max = torch.nan_to_num(row_max, neginf=0.)
+    sums = torch.zeros(shape, dtype=values.dtype, device=values.device).index_add(
+        -1, rows, torch.exp(values - row_max[..., rows])
+    )
+    
+    return torch.log(sums) + row_max
+
+
+def _check_pruning(prune_tol, n_neighbors):
+    """Validate the pruning settings of a GaussianComponentBank."""
+    
+    if prune_tol is not None and not 0 < prune_tol <= 1:
+        raise ValueError(f"prune_tol must be in (0, 1], got {prune_tol}.")
+    if n_neighbors is not None and n_neighbors < 1:
+        raise ValueError(f"n_neighbors must be a positive integer, got {n_neighbors}.")
+
+
+class SparseLogProb():
+    def __init__(self, indptr, indices, values):
+        """
+        Log-densities of the spikes under a subset of the components each, in a 
+        CSR layout (one row per spike). Indexing w/ spike index (or a boolean mask) 
+        selects rows, as when slicing a dense (N, n_c) log-likelihood.
+        
+        Args:
+            indptr: size (N+1,) tensor
+            indices: size (nnz,) tensor; component of each entry
+            values: size (nnz,) tensor; log-density of each entry
+        """
+        
+        self.indptr, self.indices, self.values = indptr, indices, values
+        self._rows = None
+        
+        
+    def __len__(self):
+        return len(self.indptr) - 1
+    
+    
+    @property
+    def rows(self):
+        """size (nnz,) tensor; spike (row) index of each entry."""
+        if self._rows is None:
+            self._rows = _csr_rows(self.indptr)
+        return self._rows
+    
+    
+    def __getitem__(self, rows):
+        rows = torch.as_tensor(rows, device=self.indptr.device)
+        if rows.dtype == torch.bool:
+            rows = torch.nonzero(rows).reshape(-1)
+        
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        indptr = torch.zeros(len(rows) + 1, dtype=self.indptr.dtype, device=self.indptr.device)
+        indptr[1:] = torch.cumsum(lengths, 0)
+        entries = torch.repeat_interleave(starts - indptr[:-1], lengths) \
+                  + torch.arange(int(indptr[-1]), device=self.indptr.device)
+        
+        return SparseLogProb(indptr, self.indices[entries], self.values[entries])
+
+
+class GaussianComponentBank():
+    def __init__(self, means, covs, safe_covs=None, prune_tol=None, n_neighbors=None):
+        """
+        Mixture components w/ their precision factors computed once, so that the 
+        covariances are only factorized when the parameters change.
+        
+        If prune_tol or n_neighbors is set, the responsibilities are pruned: the 
+        component means are indexed w/ a KD-tree and each spike is only evaluated 
+        under the components near it (see neighbors), so the number of density 
+        evaluations per spike no longer scales w/ n_c.
+        
+        Args:
+            means: size (n_c, n_d) array or tensor
+            covs: size (n_c, n_d, n_d) array or tensor
+            safe_covs: size (n_c, n_d, n_d) array or tensor
+                       (fallback for the components whose covs become non-PSD)
+            prune_tol: accuracy bound; drop the components whose weighted density 
+                       is provably below prune_tol times that of the nearest component;
+                       only applies where the mixture weights are given (see neighbors);
+                       w/ very heterogeneous covariances, few components are dropped 
+                       and the KD-tree query cost still grows w/ n_c
+            n_neighbors: keep at most the n_neighbors components w/ the nearest means;
+                         bounds the cost per spike, but not the accuracy
+        """
+        
+        _check_pruning(prune_tol, n_neighbors)
+        self.safe_covs = safe_covs
+        self.prune_tol, self.n_neighbors = prune_tol, n_neighbors
+        self.update(means, covs)
+        
+        
+    @classmethod
+    def from_factors(cls, means, prec_chol, log_det, prune_tol=None, n_neighbors=None):
+        """Rebuild the components from precomputed factors (e.g., in a worker)."""
+        
+        _check_pruning(prune_tol, n_neighbors)
+        components = cls.__new__(cls)
+        components.safe_covs = None
+        components.prune_tol, components.n_neighbors = prune_tol, n_neighbors
+        components.prec_chol, components.log_det = torch.as_tensor(prec_chol), torch.as_tensor(log_det)
+        components.means = torch.as_tensor(means).to(components.prec_chol)
+        components._tree = None
+        
+        return components
+    
+    
+    @classmethod
+    def from_params(cls, params):
+        """Reuse params["components"] if present; otherwise factorize params["covs"]."""
+        
+        if params.get("components") is not None:
+            return params["components"]
+        return cls(params["means"], params["covs"])
+        
+        
+    @property
+    def n_c(self):
+        return self.means.shape[0]
+    
+    
+    @property
+    def n_d(self):
+        return self.means.shape[1]
+    
+    
+    @property
+    def pruned(self):
+        return self.prune_tol is not None or self.n_neighbors is not None
+        
+        
+    def update(self, means=None, covs=None):
+        """
+        Update the components in place (e.g., after an M step); the covariances 
+        are refactorized only if new covs are given.
+        
+        Args:
+            means: size (n_c, n_d) array or tensor
+            covs: size (n_c, n_d, n_d) array or tensor
+        """
+        
+        if covs is not None:
+            self.prec_chol, self.log_det = compute_precision_cholesky(covs, self.safe_covs)
+        if means is not None:
+            self.means = torch.as_tensor(means).to(self.prec_chol)
+        self._tree = None
+            
+            
+    def log_prob(self, s, chunk_size=None):
+        """
+        Args:
+            s: size (N, n_d) array or tensor
+            chunk_size: number of spikes evaluated at a time
+            
+        Returns:
+            ll: size (N, n_c) tensor; log-density of each spike under each component
+        """
+        
+        return gaussian_log_prob(s, self.means, self.prec_chol, self.log_det, chunk_size)
+    
+    
+    def responsibility_sums(self, s, segment_idxs, log_weights, chunk_size=None):
+        """
+        Args:
+            s: size (N, n_d) array or tensor
+            segment_idxs: size (N,) array; segment index of each spike
+            log_weights: size (n_s, n_c) array; log mixture weights of each segment
+            chunk_size: number of spikes evaluated at a time
+            
+        Returns:
+            resp_sums: size (n_s, n_c) tensor (see segment_responsibility_sums)
+        """
+        
+        if not self.pruned:
+            return segment_responsibility_sums(
+                s, segment_idxs, log_weights, self.means, self.prec_chol, self.log_det, chunk_size
+            )
+        
+        s = torch.as_tensor(s).to(self.prec_chol)
+        segment_idxs = torch.as_tensor(segment_idxs, dtype=torch.long, device=s.device)
+        log_weights = torch.as_tensor(log_weights).to(s)
+        if chunk_size is None:
+            chunk_size = 2**16
+            
+        resp_sums = torch.zeros(log_weights.shape, dtype=s.dtype, device=s.device)
+        for start in range(0, s.shape[0], chunk_size):
+            chunk_segment_idxs = segment_idxs[start:start+chunk_size]
+            indptr, indices, resp = self._pruned_responsibilities(
+                s[start:start+chunk_size], chunk_segment_idxs, log_weights
+            )
+            resp_sums.view(-1).index_add_(
+                0, chunk_segment_idxs[_csr_rows(indptr)] * self.n_c + indices, resp
+            )
+            
+        return resp_sums
+    
+    
+    def _neighbor_tree(self):
+        """
+        KD-tree over the means, w/ the log-normalizer and the largest covariance 
+        eigenvalue of each component (built once per set of parameters).
+        """
+        
+        if self._tree is None:
+            comp_const = (self.log_det - .5 * self.n_d * np.log(2 * np.pi)).cpu().numpy()
+            comp_var = torch.linalg.svdvals(self.prec_chol).amin(-1).pow(-2).cpu().numpy()
+            self._tree = (KDTree(self.means.cpu().numpy()), comp_const, comp_var)
+            
+        return self._tree
+    
+    
+    def neighbors(self, s, segment_idxs=None, log_weights=None):
+        """
+        Find the components under which each spike is evaluated in the pruned mode.
+        
+        The log-density of component c at spike s is at most 
+        const_c - |s - mean_c|^2 / (2 * var_c), where const_c is the log-normalizer 
+        and var_c the largest covariance eigenvalue of c. Each component whose bound 
+        is below prune_tol times the density of the component w/ the nearest mean is 
+        dropped; the bound holds for the weighted densities (i.e., the 
+        responsibilities), so prune_tol only applies w/ log_weights (otherwise only 
+        n_neighbors prunes). The candidates are found w/ one KD-tree radius query 
+        per spike, whose radius uses the largest const_c and var_c of all components; 
+        w/ very heterogeneous covariances this radius is loose, so the query (though 
+        not the density evaluations) still grows w/ n_c. n_neighbors caps the number 
+        of components per spike, which is not covered by the bound.
+        
+        Args:
+            s: size (N, n_d) array or tensor
+            segment_idxs: size (N,) array; segment index of each spike
+            log_weights: size (n_s, n_c) array; log mixture weights of each segment
+            
+        Returns:
+            indptr: size (N+1,) tensor
+            indices: size (nnz,) tensor; components of each spike (CSR layout)
+        """
+        
+        s = torch.as_tensor(s).to(self.prec_chol)
+        x = s.cpu().numpy()
+        tree, comp_const, comp_var = self._neighbor_tree()
+        n_neighbors = self.n_c if self.n_neighbors is None else min(self.n_neighbors, self.n_c)
+        
+        if len(x) == 0:
+            lengths, indices = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+            
+        elif self.prune_tol is None or log_weights is None:
+            _, indices = tree.query(x, k=n_neighbors)
+            lengths, indices = np.full(len(x), n_neighbors), indices.reshape(-1)
+            
+        else:
+            _, nearest = tree.query(x, k=1)
+            nearest = nearest[:,0]
+            thresholds = _pairwise_log_prob(
+                s, self.means, self.prec_chol, self.log_det, 
+                torch.arange(len(x), device=s.device), torch.as_tensor(nearest, device=s.device)
+            ).cpu().numpy() + np.log(self.prune_tol)
+            log_weights = torch.as_tensor(log_weights).cpu().numpy()
+            segment_idxs = torch.as_tensor(segment_idxs).cpu().numpy()
+            thresholds = thresholds + log_weights[segment_idxs, nearest]
+            gaps = comp_const.max() + log_weights.max(1)[segment_idxs] - thresholds
+            with np.errstate(invalid="ignore"):
+                gaps = np.clip(np.nan_to_num(gaps, nan=np.inf, posinf=np.inf), 0, None)
+            radius = np.sqrt(2 * comp_var.max() * gaps)
+            
+            if self.n_neighbors is None:
+                indices, dists = tree.query_radius(x, radius, return_distance=True)
+                lengths = np.array([len(i) for i in indices])
+                indices, dists = np.concatenate(indices), np.concatenate(dists)
+            else:
+                dists, indices = tree.query(x, k=n_neighbors)
+                lengths = np.full(len(x), n_neighbors)
+                indices, dists = indices.reshape(-1), dists.reshape(-1)
+            
+            # re-check the candidates w/ the bound of their own component
+            rows = np.repeat(np.arange(len(x)), lengths)
+            bounds = comp_const[indices] - dists**2 / (2 * comp_var[indices]) \
+                     + log_weights[segment_idxs[rows], indices]
+            keep = bounds >= thresholds[rows]
+            lengths = np.bincount(rows[keep], minlength=len(x))
+            indices = indices[keep]
+        
+        indptr = torch.as_tensor(np.r_[0, np.cumsum(lengths)], dtype=torch.long, device=s.device)
+        indices = torch.as_tensor(indices, dtype=torch.long, device=s.device)
+        
+        return indptr, indices
+    
+    
+    def sparse_log_prob(self, s, segment_idxs=None, log_weights=None):
+        """
+        Log-density of each spike under its neighboring components only.
+        
+        Args:
+            s: size (N, n_d) array or tensor
+            segment_idxs, log_weights: see neighbors
+            
+        Returns:
+            ll: a SparseLogProb w/ one row per spike
+        """
+        
+        s = torch.as_tensor(s).to(self.prec_chol)
+        indptr, indices = self.neighbors(s, segment_idxs, log_weights)
+        ll = SparseLogProb(indptr, indices, None)
+        ll.values = _pairwise_log_prob(
+            s, self.means, self.prec_chol, self.log_det, ll.rows, indices
+        )
+        
+        return ll
+    
+    
+    def _pruned_responsibilities(self, s, segment_idxs, log_weights):
+        """Pruned responsibilities as (indptr, indices, resp) tensors."""
+        
+        ll = self.sparse_log_prob(s, segment_idxs, log_weights)
+        logits = ll.values + log_weights[segment_idxs[ll.rows], ll.indices]
+        resp = torch.exp(logits - csr_logsumexp(logits, ll.rows, len(ll))[ll.rows])
+        
+        return ll.indptr, ll.indices, resp
+    
+    
+    def responsibilities(self, s, segment_idxs, log_weights):
+        """
+        Pruned posterior responsibilities of the spikes.
+        
+        Args:
+            s: size (N, n_d) array or tensor
+            segment_idxs: size (N,) array; segment index of each spike
+            log_weights: size (n_s, n_c) array; log mixture weights of each segment
+            
+        Returns:
+            resp: size (N, n_c) scipy.sparse CSR matrix
+        """
+        
+        s = torch.as_tensor(s).to(self.prec_chol)
+        segment_idxs = torch.as_tensor(segment_idxs, dtype=torch.long, device=s.device)
+        log_weights = torch.as_tensor(log_weights).to(s)
+        indptr, indices, resp = self._pruned_responsibilities(s, segment_idxs, log_weights)
+        
+        return csr_matrix(
+            (resp.cpu().numpy(), indices.cpu().numpy(), indptr.cpu().numpy()), 
+            shape=(s.shape[0], self.n_c)
+        )
@@ -0,0 +1,408 @@
+"""Functions for binning spike and behavior data into trials and time bins."""
+
+import numpy as np
+import scipy.sparse
+
+
+def concat_ranges(starts, ends):
+    """
+    Concatenate the integer ranges [starts[i], ends[i]) without a Python loop.
+
+    Args:
+        starts: size (n,) integer array
+        ends: size (n,) integer array
+
+    Returns:
+        idxs: size (sum(counts),) array; concatenated ranges
+        counts: size (n,) array; length of each range
+    """
+
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    counts = np.maximum(ends - starts, 0)
+    shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    idxs = np.arange(counts.sum()) + shifts
+
+    return idxs, counts
+
+
+def group_by_key(keys):
+    """
+    Sort items by key once so that every group is a contiguous slice.
+
+    Args:
+        keys: size (N,) array
+
+    Returns:
+        order: size (N,) array; stable permutation that sorts the keys
+        unique_keys: size (n_g,) array; sorted unique keys
+        offsets: size (n_g+1,) array; group g is order[offsets[g]:offsets[g+1]]
+    """
+
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind="stable")
+    unique_keys, offsets = np.unique(keys[order], return_index=True)
+    offsets = np.append(offsets, len(keys))
+
+    return order, unique_keys, offsets
+
+
+def bin_trial_windows(
+    times,
+    window_starts,
+    window_ends,
+    t_binning,
+    n_t_bins
+):
+    """
+    Assign events to trial windows and time bins in a single linear pass.
+
+    Events are sorted by time once (skipped if already sorted); each window
+    is then located with searchsorted. As in the original per-trial masks,
+    windows are closed on both ends and time bins are measured relative to
+    the first event within each window.
+
+    Args:
+        times: size (N,) array (in seconds)
+        window_starts: size (n_k,) array, n_k = number of trials (in seconds)
+        window_ends: size (n_k,) array (in seconds)
+        t_binning: size (n_t,) array; left edges of the time bins (in seconds)
+        n_t_bins: number of time bins within each trial
+
+    Returns:
+        event_idxs: size (M,) array; index into `times` of each binned event
+        trial_idxs: size (M,) array; window index of each binned event
+        time_idxs: size (M,) array; time bin index of each binned event
+        (the outputs are sorted by trial, time bin and then event index)
+    """
+
+    times = np.asarray(times).ravel()
+    window_starts = np.asarray(window_starts).ravel()
+    window_ends = np.asarray(window_ends).ravel()
+
+    is_sorted = np.all(times[1:] >= times[:-1])
+    order = None if is_sorted else np.argsort(times, kind="stable")
+    sorted_times = times if is_sorted else times[order]
+
+    lo = np.searchsorted(sorted_times, window_starts, side="left")
+    hi = np.searchsorted(sorted_times, window_ends, side="right")
+
+    # positions (in sorted order) of every event in every window
+    pos, counts = concat_ranges(lo, hi)
+    trial_idxs = np.repeat(np.arange(len(counts)), counts)
+
+    offsets = sorted_times[pos] - sorted_times[lo[trial_idxs]]
+    time_idxs = np.searchsorted(t_binning, offsets, side="right") - 1
+
+    keep = np.logical_and(time_idxs >= 0, time_idxs < n_t_bins)
+    event_idxs = pos[keep] if is_sorted else order[pos[keep]]
+    trial_idxs, time_idxs = trial_idxs[keep], time_idxs[keep]
+
+    if not is_sorted:
+        # restore the original event order within each (trial, time bin)
+        reorder = np.lexsort((event_idxs, time_idxs, trial_idxs))
+        event_idxs = event_idxs[reorder]
+        trial_idxs, time_idxs = trial_idxs[reorder], time_idxs[reorder]
+
+    return event_idxs, trial_idxs, time_idxs
+
+
+def bin_aligned_windows(times, align_times, pre_time, post_time, bin_size):
+    """
+    Assign events to fixed-width time bins around each alignment time in a single 
+    linear pass (bins span [align_time - pre_time, align_time + post_time)).
+
+    Args:
+        times: size (N,) array, sorted (in seconds)
+        align_times: size (n_k,) array, n_k = number of trials (in seconds)
+        pre_time: time before each alignment time (in seconds)
+        post_time: time after each alignment time (in seconds)
+        bin_size: width of the time bins (in seconds)
+
+    Returns:
+        event_idxs: size (M,) array; index into `times` of each binned event
+        trial_idxs: size (M,) array; trial index of each binned event
+        time_idxs: size (M,) array; time bin index of each binned event
+        bin_centers: size (n_t,) array; center of each time bin relative to the 
+                     alignment time
+    """
+
+    times = np.asarray(times).ravel()
+    align_times = np.asarray(align_times).ravel()
+    n_bins_pre = int(np.ceil(pre_time / bin_size))
+    n_bins_post = int(np.ceil(post_time / bin_size))
+    n_t_bins = n_bins_pre + n_bins_post
+    bin_edges = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+    window_starts, window_ends = align_times + bin_edges[0], align_times + bin_edges[-1]
+
+    lo, hi = np.searchsorted(times, window_starts), np.searchsorted(times, window_ends)
+    event_idxs, counts = concat_ranges(lo, hi)
+    trial_idxs = np.repeat(np.arange(len(align_times)), counts)
+    time_idxs = np.floor((times[event_idxs] - window_starts[trial_idxs]) / bin_size).astype(np.int64)
+
+    keep = np.logical_and(time_idxs >= 0, time_idxs < n_t_bins)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    return event_idxs[keep], trial_idxs[keep], time_idxs[keep], bin_centers
+
+
+def sum_trial_bins(trial_idxs, time_idxs, n_trials, n_t_bins, weights=None):
+    """
+    Sum the weights (or count the events) in each (trial, time bin) w/ flat bincounts.
+
+    Args:
+        trial_idxs: size (M,) array; trial index of each event
+        time_idxs: size (M,) array; time bin index of each event
+        n_trials: number of trials
+        n_t_bins: number of time bins within each trial
+        weights: size (M,) or (M, n_w) array; weight of each event (counts if None)
+
+    Returns:
+        bin_sums: size (n_k, n_t) or (n_k, n_t, n_w) array
+    """
+
+    bin_idxs = trial_idxs * n_t_bins + time_idxs
+    if weights is None:
+        bin_sums = np.bincount(bin_idxs, minlength=n_trials * n_t_bins).astype(float)
+        return bin_sums.reshape(n_trials, n_t_bins)
+
+    weights = np.asarray(weights)
+    bin_sums = np.stack([
+        np.bincount(bin_idxs, weights=w, minlength=n_trials * n_t_bins)
+        for w in weights.reshape(len(weights), -1).T
+    ], axis=-1)
+
+    return bin_sums.reshape((n_trials, n_t_bins) + weights.shape[1:])
+
+
+def compute_spike_count_histogram(
+    spike_times,
+    spike_units,
+    window_starts,
+    window_ends,
+    t_binning,
+    n_t_bins,
+    n_units=None,
+    sparse=False
+):
+    """
+    Compute the (trial, unit, time bin) spike count histogram for the whole
+    session with a single flat bincount.
+
+    Args:
+        spike_times: size (N,) array (in seconds)
+        spike_units: size (N,) array (sorted / thresholded units)
+        window_starts: size (n_k,) array, n_k = number of trials (in seconds)
+        window_ends: size (n_k,) array (in seconds)
+        t_binning: size (n_t,) array; left edges of the time bins (in seconds)
+        n_t_bins: number of time bins within each trial
+        n_units: number of units; defaults to max(spike_units) + 1
+        sparse: whether to return a scipy.sparse matrix
+
+    Returns:
+        spike_count_mat: size (n_k, n_c, n_t) array; or if sparse,
+                         size (n_k, n_c * n_t) scipy.sparse.csr_matrix
+    """
+
+    spike_units = np.asarray(spike_units).astype(int)
+    n_trials = len(window_starts)
+    if n_units is None:
+        n_units = spike_units.max() + 1 if len(spike_units) > 0 else 0
+
+    spike_idxs, trial_idxs, time_idxs = bin_trial_windows(
+        spike_times, window_starts, window_ends, t_binning, n_t_bins
+    )
+    unit_time_idxs = spike_units[spike_idxs] * n_t_bins + time_idxs
+
+    if sparse:
+        spike_count_mat = scipy.sparse.coo_matrix(
+            (np.ones(len(spike_idxs)), (trial_idxs, unit_time_idxs)),
+            shape=(n_trials, n_units * n_t_bins)
+        ).tocsr()
+    else:
+        spike_count_mat = np.bincount(
+            trial_idxs * (n_units * n_t_bins) + unit_time_idxs,
+            minlength=n_trials * n_units * n_t_bins
+        ).reshape(n_trials, n_units, n_t_bins).astype(float)
+
+    return spike_count_mat
+
+
+def bin_trial_means(
+    times,
+    values,
+    window_starts,
+    window_ends,
+    t_binning,
+    n_t_bins
+):
+    """
+    Average any number of signals sampled at the same timestamps within each
+    (trial, time bin); bin assignment is computed once for all signals.
+
+    Args:
+        times: size (n_time_points,) array (in seconds)
+        values: size (n_time_points,) or (n_time_points, n_b) array
+        window_starts: size (n_k,) array, n_k = number of trials (in seconds)
+        window_ends: size (n_k,) array (in seconds)
+        t_binning: size (n_t,) array; left edges of the time bins (in seconds)
+        n_t_bins: number of time bins within each trial
+
+    Returns:
+        bin_values: size (n_k, n_t) or (n_k, n_t, n_b) array (NaN for empty bins)
+    """
+
+    values = np.asarray(values)
+    n_trials = len(window_starts)
+    event_idxs, trial_idxs, time_idxs = bin_trial_windows(
+        times, window_starts, window_ends, t_binning, n_t_bins
+    )
+    counts = sum_trial_bins(trial_idxs, time_idxs, n_trials, n_t_bins)
+    sums = sum_trial_bins(trial_idxs, time_idxs, n_trials, n_t_bins, values[event_idxs])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bin_values = sums / counts.reshape(counts.shape + (1,) * (sums.ndim - 2))
+
+    return bin_values
+
+
+class BinnedSpikes():
+    def __init__(
+        self,
+        spike_features,
+        trial_idxs,
+        time_idxs,
+        n_trials,
+        n_t_bins
+    ):
+        """
+        Compact (CSR-style) container for spikes binned into trials and time bins.
+
+        Spikes are stored in one contiguous array sorted by (trial, time bin),
+        together with an offsets table so that the spikes of a trial or of a
+        (trial, time bin) are zero-copy views.
+
+        Args:
+            spike_features: size (N, 1+n_d) array sorted by (trial, time bin);
+                            the first column holds the spike channels
+            trial_idxs: size (N,) array; trial index of each spike
+            time_idxs: size (N,) array; time bin index of each spike
+            n_trials: number of trials
+            n_t_bins: number of time bins within each trial
+        """
+
+        self.spike_features = spike_features
+        self.trial_idxs = np.asarray(trial_idxs).astype(int)
+        self.time_idxs = np.asarray(time_idxs).astype(int)
+        self.n_trials = n_trials
+        self.n_t_bins = n_t_bins
+
+        bin_idxs = self.trial_idxs * n_t_bins + self.time_idxs
+        assert np.all(bin_idxs[1:] >= bin_idxs[:-1]), "spikes must be sorted by (trial, time bin)."
+        self.offsets = np.searchsorted(bin_idxs, np.arange(n_trials * n_t_bins + 1))
+
+
+    @classmethod
+    def from_nested(cls, bin_spike_features):
+        """
+        Build the container from the nested list format:
+            for each k:
+                for each t:
+                    size (n_t_k, 1+n_d) array, n_d = spike feature dim
+        """
+
+        n_trials, n_t_bins = len(bin_spike_features), len(bin_spike_features[0])
+        bins = [x for spike_train_per_k in bin_spike_features for x in spike_train_per_k]
+        counts = np.array([len(x) for x in bins])
+        bin_idxs = np.repeat(np.arange(n_trials * n_t_bins), counts)
+
+        return cls(
+            np.concatenate(bins),
+            bin_idxs // n_t_bins,
+            bin_idxs % n_t_bins,
+            n_trials,
+            n_t_bins
+        )
+
+
+    def __len__(self):
+        return self.n_trials
+
+
+    def __getitem__(self, k):
+        """Compatibility with the nested list format, i.e., x[k][t]."""
+        return [self.bin(k, t) for t in range(self.n_t_bins)]
+
+
+    @property
+    def bin_counts(self):
+        """size (n_k, n_t) array; number of spikes in each (trial, time bin)."""
+        return np.diff(self.offsets).reshape(self.n_trials, self.n_t_bins)
+
+
+    def trial(self, k):
+        """size (n_spikes_k, 1+n_d) view of the spikes in trial k."""
+        return self.spike_features[
+            self.offsets[k * self.n_t_bins]:self.offsets[(k + 1) * self.n_t_bins]
+        ]
+
+
+    def bin(self, k, t):
+        """size (n_t_k, 1+n_d) view of the spikes in time bin t of trial k."""
+        i = k * self.n_t_bins + t
+        return self.spike_features[self.offsets[i]:self.offsets[i + 1]]
+
+
+    def select_trials(self, trials):
+        """
+        Gather the spikes of a subset of trials (in ascending trial order).
+
+        Args:
+            trials: trial index to keep
+
+        Returns:
+            spike_features: size (n, 1+n_d) array
+            trial_idxs: size (n,) array
+            time_idxs: size (n,) array
+        """
+
+        trials = np.unique(trials).astype(int)
+        idxs, _ = concat_ranges(
+            self.offsets[trials * self.n_t_bins],
+            self.offsets[(trials + 1) * self.n_t_bins]
+        )
+
+        return self.spike_features[idxs], self.trial_idxs[idxs], self.time_idxs[idxs]
+
+
+    def to_nested(self):
+        """
+        Convert back to the nested list format.
+
+        Returns:
+            bin_spike_features: a nested list w/ the structure:
+                                for each k:
+                                    for each t:
+                                        size (n_t_k, 1+n_d) array, n_d = spike feature dim
+            bin_trial_idxs: a list of trial index
+            bin_time_idxs: a list of time bin index
+        """
+
+        bin_spike_features = [self[k] for k in range(self.n_trials)]
+        counts = self.bin_counts
+        bin_trial_idxs = [
+            np.full(counts[k, t], k, dtype=float) 
+            for k in range(self.n_trials) for t in range(self.n_t_bins)
+        ]
+        bin_time_idxs = [
+            np.full(counts[k, t], t, dtype=float) 
+            for k in range(self.n_trials) for t in range(self.n_t_bins)
+        ]
+
+        return bin_spike_features, bin_trial_idxs, bin_time_idxs
+
+
+def as_binned_spikes(bin_spike_features):
+    """Accept either a BinnedSpikes container or the nested list format."""
+
+    if isinstance(bin_spike_features, BinnedSpikes):
+        return bin_spike_features
+    return BinnedSpikes.from_nested(bin_spike_features)
@@ -2,7 +2,6 @@
 
 import os
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
 
 from one.api import ONE
@@ -14,6 +13,18 @@ import brainbox.behavior.wheel as wh
 import isosplit
 from sklearn.mixture import GaussianMixture
 
+from density_decoding.utils.binning import (
+    group_by_key,
+    bin_trial_windows, 
+    bin_trial_means, 
+    bin_aligned_windows, 
+    sum_trial_bins, 
+    compute_spike_count_histogram, 
+    BinnedSpikes
+)
+from density_decoding.utils.worker_pool import get_worker_pool
+from density_decoding.utils.linalg import compute_precision_cholesky
+
 
 class BaseDataLoader():
     def __init__(
@@ -55,12 +66,13 @@ class BaseDataLoader():
             valid_trials: trial index to keep
         
         Returns:
-            bin_spike_features: a nested list w/ the structure:
+            bin_spike_features: a BinnedSpikes container w/ the structure:
                                 for each k:
                                     for each t:
                                         size (n_t_k, 1+n_d) array, n_d = spike feature dim
-            bin_trial_idxs: a list of trial index
-            bin_time_idxs: a list of time bin index
+                                (use .to_nested() for the nested list format)
+            bin_trial_idxs: size (N_binned,) array of trial index
+            bin_time_idxs: size (N_binned,) array of time bin index
         """
         
         n_trials = len(trial_start_times)
@@ -68,28 +80,21 @@ class BaseDataLoader():
         if valid_trials is None:
             valid_trials = np.arange(n_trials) 
             
-        spike_train = np.c_[spike_times, spike_channels, spike_features]
+        spike_idxs, trial_idxs, time_idxs = bin_trial_windows(
+            spike_times, 
+            trial_start_times[valid_trials], 
+            trial_end_times[valid_trials], 
+            self.t_binning, 
+            self.n_t_bins
+        )
+        dtype = np.result_type(spike_times, spike_channels, spike_features)
+        spike_train = np.c_[spike_channels, spike_features].astype(dtype)[spike_idxs]
         
-        bin_spike_features = []
-        bin_trial_idxs, bin_time_idxs = [], []
-        for k_idx in tqdm(range(len(valid_trials)), desc="Process spike features"):
-            
-            k = valid_trials[k_idx]
-            mask = np.logical_and(
-                spike_times >= trial_start_times[k],   
-                spike_times <= trial_end_times[k]
-            )
-            sub_spike_train = spike_train[mask]
-            sub_spike_train[:,0] = sub_spike_train[:,0] - sub_spike_train[:,0].min()
-            t_bin_mask = np.digitize(sub_spike_train[:,0], self.t_binning, right=False).flatten() - 1
-            
-            spike_train_per_k = []
-            for t in range(self.n_t_bins):
-                spike_train_per_t_bin = sub_spike_train[t_bin_mask == t, 1:]
-                spike_train_per_k.append(spike_train_per_t_bin)
-                bin_trial_idxs.append(np.ones_like(spike_train_per_t_bin.T[0]) * k_idx)
-                bin_time_idxs.append(np.ones_like(spike_train_per_t_bin.T[0]) * t)
-            bin_spike_features.append(spike_train_per_k)
+        bin_spike_features = BinnedSpikes(
+            spike_train, trial_idxs, time_idxs, len(valid_trials), self.n_t_bins
+        )
+        bin_trial_idxs = bin_spike_features.trial_idxs
+        bin_time_idxs = bin_spike_features.time_idxs
             
         return bin_spike_features, bin_trial_idxs, bin_time_idxs
     
@@ -106,32 +111,26 @@ class BaseDataLoader():
         
         Args:
             time_points: size (n_time_points,) array (in seconds)
-            raw_behaviors: size (n_time_points,) array
+            raw_behaviors: size (n_time_points,) or (n_time_points, n_b) array
+                           (n_b behaviors sampled at the same time points)
             trial_start_times: size (n_k,) array, n_k = number of trials (in seconds)
             trial_end_times: size (n_k,) array (in seconds)
         
         Returns:
-            bin_behaviors: size (n_k, n_t) array
+            bin_behaviors: size (n_k, n_t) or (n_k, n_t, n_b) array
         """
         
-        n_trials = len(trial_start_times)
         time_points = time_points.squeeze()
         raw_behaviors = raw_behaviors.squeeze()
-        behavior_data = np.c_[time_points, raw_behaviors]
         
-        bin_behaviors = np.zeros((n_trials, self.n_t_bins))
-        for k in tqdm(range(n_trials), desc="Process behaviors"):
-            
-            mask = np.logical_and(
-                time_points >= trial_start_times[k],   
-                time_points <= trial_end_times[k]
-            )
-            sub_behaviors = behavior_data[mask]
-            sub_behaviors[:,0] = sub_behaviors[:,0] - sub_behaviors[:,0].min()
-            t_bin_mask = np.digitize(sub_behaviors[:,0], self.t_binning, right=False).flatten() - 1
-            
-            for t in range(self.n_t_bins):
-                bin_behaviors[k, t] = sub_behaviors[t_bin_mask == t, 1].mean()
+        bin_behaviors = bin_trial_means(
+            time_points, 
+            raw_behaviors, 
+            trial_start_times, 
+            trial_end_times, 
+            self.t_binning, 
+            self.n_t_bins
+        )
         
         return bin_behaviors
     
@@ -142,7 +141,8 @@ class BaseDataLoader():
         spike_units, 
         trial_start_times,
         trial_end_times,
-        valid_trials = None
+        valid_trials = None,
+        sparse = False
     ):
         """
         Compute spike count matrix for spike-sorted and thresholded decoders.
@@ -153,38 +153,25 @@ class BaseDataLoader():
             trial_start_times: size (n_k,) array, n_k = number of trials (in seconds)
             trial_end_times: size (n_k,) array (in seconds)
             valid_trials: trial index to keep
+            sparse: whether to return a scipy.sparse matrix
             
         Returns:
-            spike_count_mat: size (n_k, n_c, n_t) array
+            spike_count_mat: size (n_k, n_c, n_t) array; or if sparse, 
+                             size (n_k, n_c * n_t) scipy.sparse.csr_matrix
         """
         
         n_trials = len(trial_start_times)
         valid_trials = np.arange(n_trials) if valid_trials is None else valid_trials
-            
-        spike_train = np.c_[spike_times, spike_units]
-
-        spike_count_mat = []
-        n_units = spike_units.max().astype(int) + 1
-        for idx in tqdm(range(len(valid_trials)), desc="Compute spike count"):
-            k = valid_trials[idx]
-            
-            mask = np.logical_and(
-                spike_times >= trial_start_times[k],
-                spike_times <= trial_end_times[k]
-            )
-            sub_spike_train = spike_train[mask]
-            
-            spike_count = np.zeros([n_units, self.n_t_bins])
-            try:
-                sub_spike_train[:,0] = sub_spike_train[:,0] - sub_spike_train[:,0].min()
-                units = sub_spike_train[:,1].astype(int)
-                t_bins = np.digitize(sub_spike_train[:,0], self.t_binning, right=False) - 1
-                np.add.at(spike_count, (units, t_bins), 1) 
-            except ValueError:
-                print(f"no spikes in trial {k}.")
-            spike_count_mat.append(spike_count)
-            
-        spike_count_mat = np.array(spike_count_mat)
+        
+        spike_count_mat = compute_spike_count_histogram(
+            spike_times, 
+            spike_units, 
+            trial_start_times[valid_trials], 
+            trial_end_times[valid_trials], 
+            self.t_binning, 
+            self.n_t_bins, 
+            sparse=sparse
+        )
         
         return spike_count_mat
     
@@ -239,6 +226,13 @@ class IBLDataLoader(BaseDataLoader):
         print(np.unique(self.clusters["acronym"]))
 
         
+    def _region_lookup_table(self, partition_units, region):
+        """Build a unit (channel / cluster) -> region membership lookup table."""
+        
+        acronyms = np.char.lower(np.asarray(partition_units["acronym"]).astype(str))
+        return np.char.find(acronyms, region) >= 0
+    
+    
     def _partition_brain_regions(
         self, 
         data, 
@@ -249,43 +243,37 @@ class IBLDataLoader(BaseDataLoader):
     ):
         """Partition data into different brain regions."""
         
-        rois = partition_units["acronym"]
-        rois = np.c_[np.arange(rois.shape[0]), rois]
-        rois = rois[[region in x.lower() for x in rois[:,-1]], 0]
-        rois = np.unique(rois).astype(int)
+        is_roi = self._region_lookup_table(partition_units, region)
         
         if len(good_units) != 0:
-            rois = np.intersect1d(rois, good_units)
-        print(f"found {len(rois)} {partition_type} in region {region}")
-        
-        regional = []
-        for idx in tqdm(range(len(rois)), desc="Partition brain regions"):
-            roi = rois[idx]
-            regional.append(data[data[:,1] == roi])
+            is_roi = np.logical_and(is_roi, np.isin(np.arange(len(is_roi)), good_units))
+        n_rois = is_roi.sum()
+        print(f"found {n_rois} {partition_type} in region {region}")
+        if n_rois == 0:
+            raise ValueError(f"no {partition_type} found in region {region}.")
             
-        return np.vstack(regional)
+        return data[is_roi[data[:,1].astype(int)]]
     
     
     def _partition_into_trials(self, data):
         """Partition data into different trials."""
         
-        trials = []
-        for i in range(self.n_trials):
-            mask = np.logical_and(
-                data[:,0] >= self.stim_on_times[i] - self.t_before,   
-                data[:,0] <= self.stim_on_times[i] + self.t_after
-            )
-            trials.append(data[mask])
+        if not np.all(data[1:,0] >= data[:-1,0]):
+            data = data[np.argsort(data[:,0], kind="stable")]
+        
+        lo = np.searchsorted(data[:,0], self.stim_on_times - self.t_before, side="left")
+        hi = np.searchsorted(data[:,0], self.stim_on_times + self.t_after, side="right")
             
-        return trials
+        return [data[l:h] for l, h in zip(lo, hi)]
     
     
-    def load_all_sorted_units(self, region="all"):
+    def load_all_sorted_units(self, region="all", sparse=False):
         """
         Load all single units sorted by Kilosort 2.5. 
         
         Args:
             region: selected brain regions
+            sparse: whether to return a scipy.sparse matrix
             
         Returns:
             spike_count_mat: size (n_k, n_c, n_t) array
@@ -307,18 +295,20 @@ class IBLDataLoader(BaseDataLoader):
         spike_count_mat = self.compute_spike_count_matrix(
             spike_times, 
             spike_units, 
-            is_regional = is_regional
+            is_regional = is_regional,
+            sparse = sparse
         )
         
         return spike_count_mat
         
     
-    def load_good_sorted_units(self, region="all"):
+    def load_good_sorted_units(self, region="all", sparse=False):
         """
         Load single units that meet the quality control criteria. 
         
         Args:
             region: selected brain regions
+            sparse: whether to return a scipy.sparse matrix
             
         Returns:
             spike_count_mat: size (n_k, n_c, n_t) array
@@ -335,15 +325,11 @@ class IBLDataLoader(BaseDataLoader):
             )
         else:
             print(f"found {len(good_units)} good Kilosort units")
-            good_sorted = []
-            for good_unit in good_units:
-                good_sorted.append(sorted[sorted[:,1] == good_unit])
-            sorted = np.vstack(good_sorted)
+            sorted = sorted[np.isin(sorted[:,1], good_units)]
         
-        tmp = pd.DataFrame({"spike_time": sorted[:,0], "old_unit": sorted[:,1].astype(int)})
-        tmp["old_unit"] = tmp["old_unit"].astype("category")
-        tmp["new_unit"] = pd.factorize(tmp.old_unit)[0]
-        sorted = np.array(tmp[["spike_time", "new_unit"]])
+        # relabel the good units as 0, 1, ... in order of first appearance
+        _, new_units = _factorize(sorted[:,1].astype(int))
+        sorted = np.c_[sorted[:,0], new_units]
         
         spike_times, spike_units = np.concatenate(
             self._partition_into_trials(sorted)
@@ -352,13 +338,14 @@ class IBLDataLoader(BaseDataLoader):
         spike_count_mat = self.compute_spike_count_matrix(
             spike_times, 
             spike_units, 
-            is_regional = is_regional
+            is_regional = is_regional,
+            sparse = sparse
         )
         
         return spike_count_mat
     
     
-    def load_thresholded_units(self, spike_times, spike_channels, region="all"):
+    def load_thresholded_units(self, spike_times, spike_channels, region="all", sparse=False):
         """
         Load channels from multi-unit thresholding crossings.
         
@@ -366,6 +353,7 @@ class IBLDataLoader(BaseDataLoader):
             spike_times: size (N,) array (in time samples)
             spike_channels: size (N,) array
             region: selected brain regions
+            sparse: whether to return a scipy.sparse matrix
             
         Returns:
             spike_count_mat: size (n_k, n_c, n_t) size
@@ -389,7 +377,8 @@ class IBLDataLoader(BaseDataLoader):
         spike_count_mat = self.compute_spike_count_matrix(
             spike_times, 
             spike_units, 
-            is_regional = is_regional
+            is_regional = is_regional,
+            sparse = sparse
         )
         
         return spike_count_mat
@@ -412,10 +401,12 @@ class IBLDataLoader(BaseDataLoader):
             region: selected brain region
             
         Returns:
-            bin_spike_features: a nested list w/ the structure:
+            bin_spike_features: a BinnedSpikes container w/ the structure:
                                 for each k:
                                     for each t:
                                         size (n_t_k, 1+n_d) array, n_d = spike feature dim
+            bin_trial_idxs: size (N_binned,) array of trial index
+            bin_time_idxs: size (N_binned,) array of time bin index
         """
         
         spike_times = self.sl.samples2times(spike_times)
@@ -445,7 +436,8 @@ class IBLDataLoader(BaseDataLoader):
         self, 
         spike_times, 
         spike_units, 
-        is_regional=False
+        is_regional=False,
+        sparse=False
     ):
         """
         Compute spike count matrix for spike-sorted and thresholded decoders.
@@ -454,42 +446,28 @@ class IBLDataLoader(BaseDataLoader):
             spike_times: size (N,) array (in seconds)
             spike_units: size (N,) array (sorted / thresholded units)
             is_regional: whether from a brain region
+            sparse: whether to return a scipy.sparse matrix
             
         Returns:
-            spike_count_mat: size (n_k, n_c, n_t) array
+            spike_count_mat: size (n_k, n_c, n_t) array; or if sparse, 
+                             size (n_k, n_c * n_t) scipy.sparse.csr_matrix
         """
         
-        spike_train = np.c_[spike_times, spike_units]
-        
-        spike_count_mat = []
+        n_units = None
         if is_regional:
-            n_units = len(np.unique(spike_units))
-            tmp = pd.DataFrame({'spike_time': spike_times, 'old_unit': spike_units.astype(int)})
-            tmp['old_unit'] = tmp['old_unit'].astype('category')
-            tmp['new_unit'] = pd.factorize(tmp.old_unit)[0]
-            spike_train = np.array(tmp[['spike_time','new_unit']])
-        else:
-            n_units = spike_units.max().astype(int)+1
-            
-        for k in tqdm(range(self.n_trials), desc="Compute spike count"):
+            unique_units, spike_units = _factorize(spike_units.astype(int))
+            n_units = len(unique_units)
             
-            mask = np.logical_and(
-                spike_train[:,0] >= self.stim_on_times[k] - 0.5,
-                spike_train[:,0] <= self.stim_on_times[k] + 1.0
-            )
-            sub_spike_train = spike_train[mask]
-            
-            spike_count = np.zeros([n_units, self.n_t_bins])
-            try:
-                sub_spike_train[:,0] = sub_spike_train[:,0]-sub_spike_train[:,0].min()
-                units = sub_spike_train[:,1].astype(int)
-                t_bins = np.digitize(sub_spike_train[:,0], self.t_binning, right=False)-1
-                np.add.at(spike_count, (units, t_bins), 1) 
-            except ValueError:
-                print(f'no spikes in trial {k}.')
-            spike_count_mat.append(spike_count)
-            
-        spike_count_mat = np.array(spike_count_mat)
+        spike_count_mat = compute_spike_count_histogram(
+            spike_times, 
+            spike_units, 
+            self.stim_on_times - self.t_before, 
+            self.stim_on_times + self.t_after, 
+            self.t_binning, 
+            self.n_t_bins, 
+            n_units=n_units, 
+            sparse=sparse
+        )
         
         return spike_count_mat
     
@@ -594,16 +572,14 @@ class IBLDataLoader(BaseDataLoader):
         # wheel velocity
         bin_vel, _ = bin_norm(wheel_timestamps, ref_event, self.t_before, 
                               self.t_after, self.bin_size, weights=vel)
+        # left camera signals share timestamps, so they are binned in one pass;
+        # add paw speed / pupil diameter as extra columns once they are reliable
+        # (bin_paw_speed, bin_pup_dia = bin_left_cam[...,1], bin_left_cam[...,2])
+        bin_left_cam, _ = bin_norm(left_dlc["times"], ref_event, self.t_before, 
+                                   self.t_after, self.bin_size, 
+                                   weights=np.c_[left_dlc["ROIMotionEnergy"]])
         # left motion energy
-        bin_left_me, _ = bin_norm(left_dlc["times"], ref_event, self.t_before, 
-                                  self.t_after, self.bin_size, 
-                                  weights=left_dlc["ROIMotionEnergy"])
-        # paw speed
-        # bin_paw_speed, _ = bin_norm(left_dlc["times"], ref_event, self.t_before, 
-        #                             self.t_after, self.bin_size, weights=paw_speed)
-        # pupil diameter
-        # bin_pup_dia, _ = bin_norm(left_dlc["times"], ref_event, self.t_before, 
-        #                           self.t_after, self.bin_size, weights=pupil_diameter)
+        bin_left_me = bin_left_cam[:,:,0]
 
         behave_dict = {}
         behave_dict.update({"choice": choice})
@@ -616,12 +592,133 @@ class IBLDataLoader(BaseDataLoader):
         return behave_dict, trial_idx
     
 
+def _factorize(values):
+    """
+    Same as pd.factorize: label the unique values as 0, 1, ... in order of first 
+    appearance.
+    
+    Args:
+        values: size (N,) array
+        
+    Returns:
+        uniques: size (n_u,) array; unique values in order of first appearance
+        labels: size (N,) array
+    """
+    
+    uniques, first_idxs, labels = np.unique(values, return_index=True, return_inverse=True)
+    order = np.argsort(first_idxs)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    
+    return uniques[order], ranks[labels.reshape(-1)]
+
+
+def _estimate_gaussian_moments(sorted_spike_features, label_offsets, reg_covar=1e-6):
+    """
+    Estimate a single Gaussian per label with one grouped reduction; this gives the 
+    same parameters as fitting GaussianMixture(n_components=1) to each label.
+    
+    Args:
+        sorted_spike_features: size (n, n_d) array sorted by label
+        label_offsets: size (n_labels+1,) array; label l is [label_offsets[l], label_offsets[l+1])
+        reg_covar: non-negative regularization added to the diagonal of covariance
+    
+    Returns:
+        counts: size (n_c,) array; number of spikes of each (non-empty) label
+        means: size (n_c, n_d) array
+        covs: size (n_c, n_d, n_d) array
+    """
+    
+    n_d = sorted_spike_features.shape[1]
+    counts = np.diff(label_offsets)
+    starts = label_offsets[:-1][counts > 0]
+    counts = counts[counts > 0]
+    spike_features = sorted_spike_features[label_offsets[0]:label_offsets[-1]]
+    
+    # same normalization as sklearn.mixture.GaussianMixture
+    nk = counts + 10 * np.finfo(spike_features.dtype).eps
+    starts = starts - label_offsets[0]
+    means = np.add.reduceat(spike_features, starts, axis=0) / nk[:,None]
+    diff = spike_features - np.repeat(means, counts, axis=0)
+    covs = np.add.reduceat(
+        diff[:,:,None] * diff[:,None,:], starts, axis=0
+    ) / nk[:,None,None]
+    covs[:, np.arange(n_d), np.arange(n_d)] += reg_covar
+    
+    return counts, means, covs
+
+
+def _split_channel(subset_spike_features, n_spikes, channel=None, verbose=False):
+    """
+    Split the spikes of one channel with isosplit and fit a Gaussian to each split.
+    
+    Args:
+        subset_spike_features: size (n, n_d) array; spikes on this channel
+        n_spikes: total number of spikes (to normalize the mixture weights)
+        channel: channel id (for printing)
+        verbose: whether to print the splitting progress
+    
+    Returns:
+        None if the channel is skipped; otherwise
+        subset_weights: size (n_labels,) array
+        subset_means: size (n_labels, n_d) array
+        subset_covs: size (n_labels, n_d, n_d) array
+    """
+    
+    n_spikes_required = 10
+    min_n_spikes = 2
+    
+    if subset_spike_features.shape[0] > n_spikes_required:
+        try:
+            spike_labels = isosplit.isosplit(
+                subset_spike_features.T, 
+                K_init = 20, 
+                min_cluster_size = 10,
+                whiten_cluster_pairs = 1, 
+                refine_clusters = 1
+            )
+        except AssertionError:
+            return None
+        except ValueError:
+            return None
+    elif subset_spike_features.shape[0] < min_n_spikes:
+        return None
+    else:
+        spike_labels = np.zeros_like(subset_spike_features.T[0])
+
+    n_labels = np.unique(spike_labels).shape[0]
+    if verbose:
+        print(f'split channel {int(channel)} into {n_labels} components.')
+
+    label_order = np.argsort(spike_labels, kind="stable")
+    sorted_labels = spike_labels[label_order]
+    label_offsets = np.searchsorted(sorted_labels, np.arange(n_labels + 1), side="left")
+    
+    counts, subset_means, subset_covs = _estimate_gaussian_moments(
+        subset_spike_features[label_order], label_offsets
+    )
+    subset_weights = counts / n_spikes
+        
+    return subset_weights, subset_means, subset_covs
+
+
+def _split_shared_channel(sorted_spike_features, start, end, n_spikes, channel, verbose):
+    """Run _split_channel on the spikes [start, end) of a SharedArray (in a worker)."""
+    
+    return _split_channel(
+        sorted_spike_features.array[start:end].copy(), n_spikes, channel, verbose
+    )
+
+
 def initilize_gaussian_mixtures(
     spike_features, 
     spike_channels=None, 
     method="isosplit", 
     n_c = 100,
-    verbose=False
+    verbose=False,
+    n_workers=1,
+    cache=None,
+    pool=None
 ):
     """
     Fit a Gaussian mixture model to initialize the ADVI (CAVI) model. 
@@ -633,12 +730,24 @@ def initilize_gaussian_mixtures(
                 If spike channels are provided, use isosplit to split 
                 If spike channels not provided, use sklearn's Gaussian mixture model
         verbose: whether to print the splitting progress
+        n_workers: number of workers to split channels in parallel (isosplit only)
+        cache: a GMMCache object; if provided, reuse a mixture previously fitted 
+               to the same spikes with the same settings
+        pool: a WorkerPool to reuse (the process-wide pool w/ n_workers if None)
 
     Returns:
         gmm: an object from sklearn.mixture.GaussianMixture().
     """
     valid_methods = ["isosplit", "sklearn"]
     assert method in valid_methods, f"invalid method; expected one of {valid_methods}."
+    
+    if cache is not None:
+        key = cache.make_key(spike_features, spike_channels, method=method, n_c=n_c)
+        gmm = cache.get(key)
+        if gmm is not None:
+            if verbose:
+                print(f"loaded cached GMM with {len(gmm.weights_)} components.")
+            return gmm
 
     unique_chans = np.unique(spike_channels)
     
@@ -649,50 +758,43 @@ def initilize_gaussian_mixtures(
 
     elif method == "isosplit":
         assert spike_channels is not None, "expected spike channels as input."
-
-        n_spikes_required = 10
-        min_n_spikes = 2
         
-        subset_weights = []; subset_means = []; subset_covs = []
-        for chan_idx in tqdm(range(len(unique_chans)), desc="Initialize GMM"):
-            channel = unique_chans[chan_idx]
+        # sort spikes by channel once so that each channel is a contiguous slice
+        chan_order, unique_chans, chan_offsets = group_by_key(spike_channels)
+        sorted_spike_features = spike_features[chan_order]
+        n_spikes = len(spike_features)
+        
+        def get_channel(chan_idx):
+            return sorted_spike_features[chan_offsets[chan_idx]:chan_offsets[chan_idx+1]]
+        
+        if n_workers == 1 and pool is None:
+            outputs = [
+                _split_channel(get_channel(chan_idx), n_spikes, unique_chans[chan_idx], verbose)
+                for chan_idx in tqdm(range(len(unique_chans)), desc="Initialize GMM")
+            ]
+        else:
+            pool = get_worker_pool(n_workers) if pool is None else pool
             
-            subset_spike_features = spike_features[spike_channels == channel]
-
-            if subset_spike_features.shape[0] > n_spikes_required:
-                try:
-                    spike_labels = isosplit.isosplit(
-                        subset_spike_features.T, 
-                        K_init = 20, 
-                        min_cluster_size = 10,
-                        whiten_cluster_pairs = 1, 
-                        refine_clusters = 1
-                    )
-                except AssertionError:
-                    continue
-                except ValueError:
-                    continue
-            elif subset_spike_features.shape[0] < min_n_spikes:
-                continue
-            else:
-                spike_labels = np.zeros_like(subset_spike_features.T[0])
-
-            n_labels = np.unique(spike_labels).shape[0]
-            if verbose:
-                print(f'split channel {int(channel)} into {n_labels} components.')
-
-            for label in np.arange(n_labels):
-                mask = (spike_labels == label)
-                subset_gmm = GaussianMixture(
-                    n_components=1, 
-                    covariance_type='full',
-                    init_params='k-means++'
-                )
-                subset_gmm.fit(subset_spike_features[mask])
-                subset_labels = subset_gmm.predict(subset_spike_features[mask])
-                subset_weights.append(len(subset_labels)/len(spike_features))
-                subset_means.append(subset_gmm.means_)
-                subset_covs.append(subset_gmm.covariances_)
+            # schedule the largest channels first to balance the load across workers; 
+            # the workers read their channel from shared memory
+            schedule = np.argsort(-np.diff(chan_offsets), kind="stable")
+            shared = pool.share(sorted_spike_features)
+            try:
+                results = {chan_idx: pool.submit(
+                            _split_shared_channel, 
+                            shared, chan_offsets[chan_idx], chan_offsets[chan_idx+1], 
+                            n_spikes, unique_chans[chan_idx], verbose
+                            ) for chan_idx in schedule}
+                outputs = [results[chan_idx].get() 
+                           for chan_idx in tqdm(range(len(unique_chans)), desc="Initialize GMM")]
+            finally:
+                pool.release(shared)
+        
+        # merge in channel order so the result does not depend on scheduling
+        outputs = [out for out in outputs if out is not None]
+        subset_weights = [out[0] for out in outputs]
+        subset_means = [out[1] for out in outputs]
+        subset_covs = [out[2] for out in outputs]
 
         # aggregate the subsets of Gaussian mixture models into one overall model
         n_c = len(np.hstack(subset_weights))
@@ -702,7 +804,10 @@ def initilize_gaussian_mixtures(
         gmm.weights_ = np.hstack(subset_weights)
         gmm.means_ = np.vstack(subset_means)
         gmm.covariances_ = np.vstack(subset_covs)
-        gmm.precisions_cholesky_ = np.linalg.cholesky(np.linalg.inv(gmm.covariances_))
+        gmm.precisions_cholesky_ = compute_precision_cholesky(gmm.covariances_)[0].numpy()
+        
+    if cache is not None:
+        cache.put(key, gmm)
 
     return gmm
 
@@ -712,21 +817,14 @@ def bin_spikes(spike_times, align_times, pre_time, post_time, bin_size, weights=
     Preprocess behavioral data from IBL. Adapted from:
     https://github.com/int-brain-lab/paper-reproducible-ephys.
     """
-    n_bins_pre = int(np.ceil(pre_time / bin_size))
-    n_bins_post = int(np.ceil(post_time / bin_size))
-    n_bins = n_bins_pre + n_bins_post
-    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
-    ts = np.repeat(align_times[:, np.newaxis], tscale.size, axis=1) + tscale
-    epoch_idxs = np.searchsorted(spike_times, np.c_[ts[:, 0], ts[:, -1]])
-    bins = np.zeros(shape=(align_times.shape[0], n_bins))
-
-    for i, (ep, t) in enumerate(zip(epoch_idxs, ts)):
-        xind = (np.floor((spike_times[ep[0]:ep[1]] - t[0]) / bin_size)).astype(np.int64)
-        w = weights[ep[0]:ep[1]] if weights is not None else None
-        r = np.bincount(xind, minlength=tscale.shape[0], weights=w)
-        bins[i, :] = r[:-1]
-
-    tscale = (tscale[:-1] + tscale[1:]) / 2
+    event_idxs, trial_idxs, time_idxs, tscale = bin_aligned_windows(
+        spike_times, align_times, pre_time, post_time, bin_size
+    )
+    n_trials, n_bins = align_times.shape[0], len(tscale)
+    bins = sum_trial_bins(
+        trial_idxs, time_idxs, n_trials, n_bins, 
+        None if weights is None else np.asarray(weights)[event_idxs]
+    )
 
     return bins, tscale
 
@@ -735,12 +833,21 @@ def bin_norm(times, events, pre_time, post_time, bin_size, weights):
     """
     Preprocess behavioral data from IBL. Adapted from:
     https://github.com/int-brain-lab/paper-reproducible-ephys.
+    
+    weights can be size (N,) or (N, n_w) to average any number of signals
+    sampled at the same timestamps in one pass.
     """
-    bin_vals, t = bin_spikes(times, events, pre_time, post_time, bin_size, weights=weights)
-    bin_count, _ = bin_spikes(times, events, pre_time, post_time, bin_size)
+    event_idxs, trial_idxs, time_idxs, t = bin_aligned_windows(
+        times, events, pre_time, post_time, bin_size
+    )
+    n_trials, n_bins = events.shape[0], len(t)
+    bin_vals = sum_trial_bins(
+        trial_idxs, time_idxs, n_trials, n_bins, np.asarray(weights)[event_idxs]
+    )
+    bin_count = sum_trial_bins(trial_idxs, time_idxs, n_trials, n_bins)
     bin_count[bin_count == 0] = 1
+    if bin_vals.ndim == 3:
+        bin_count = bin_count[:, :, None]
     bin_vals = bin_vals / bin_count
 
     return bin_vals, t
-
-
@@ -0,0 +1,139 @@
+"""Persistent cache of the Gaussian mixtures used to initialize ADVI / CAVI."""
+
+import os
+import hashlib
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.mixture import GaussianMixture
+
+
+GMM_PARAMS = ["weights_", "means_", "covariances_", "precisions_cholesky_"]
+
+
+class GMMCache():
+    def __init__(
+        self,
+        cache_dir=None,
+        max_memory_items=8,
+        max_disk_bytes=2**30
+    ):
+        """
+        Cache of fitted mixtures keyed by a content hash of the spike data and
+        the initialization settings. Mixtures are memoized in memory and, if
+        cache_dir is provided, saved to disk so that reruns can reuse them.
+
+        Args:
+            cache_dir: directory to save fitted mixtures (memory only if None)
+            max_memory_items: maximum number of mixtures kept in memory
+            max_disk_bytes: maximum total size of the saved mixtures (in bytes);
+                            the least recently used files are evicted first
+        """
+
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+
+    @staticmethod
+    def make_key(spike_features, spike_channels=None, **settings):
+        """Hash the spike data and the settings into a cache key."""
+
+        h = hashlib.sha1()
+        for x in [spike_features, spike_channels]:
+            if x is None:
+                h.update(b"none")
+                continue
+            x = np.ascontiguousarray(x)
+            h.update(f"{x.dtype.str}{x.shape}".encode())
+            h.update(x.data)
+        for name in sorted(settings):
+            h.update(f"{name}={settings[name]!r};".encode())
+
+        return h.hexdigest()
+
+
+    def _path(self, key):
+        return self.cache_dir / f"gmm_{key}.npz"
+
+
+    def get(self, key):
+        """Return the cached mixture or None."""
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return _to_gmm(self._memory[key])
+
+        if self.cache_dir is None or not self._path(key).exists():
+            return None
+
+        with np.load(self._path(key)) as f:
+            params = {name: f[name] for name in GMM_PARAMS}
+        # mark as recently used for eviction
+        os.utime(self._path(key))
+        self._remember(key, params)
+
+        return _to_gmm(params)
+
+
+    def put(self, key, gmm):
+        """Add a fitted mixture to the cache."""
+
+        params = {name: np.asarray(getattr(gmm, name)) for name in GMM_PARAMS}
+        self._remember(key, params)
+
+        if self.cache_dir is not None:
+            # write to a temporary file first so that readers never see partial files
+            tmp_path = self.cache_dir / f"tmp_{key}_{os.getpid()}.npz"
+            np.savez(tmp_path, **params)
+            os.replace(tmp_path, self._path(key))
+            self._evict_disk()
+
+
+    def _remember(self, key, params):
+        self._memory[key] = params
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+
+    def _evict_disk(self):
+        files = sorted(self.cache_dir.glob("gmm_*.npz"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        # never evict the most recent file
+        for f in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+
+
+def _to_gmm(params):
+    """Rebuild a GaussianMixture object from its cached parameters."""
+
+    gmm = GaussianMixture(
+        n_components = len(params["weights_"]),
+        covariance_type = 'full',
+        init_params = 'k-means++'
+    )
+    for name in GMM_PARAMS:
+        setattr(gmm, name, params[name].copy())
+
+    return gmm
+
+
+_caches = {}
+
+def get_gmm_cache(cache_dir=None):
+    """Return the cache shared by all calls in this process for cache_dir."""
+
+    key = None if cache_dir is None else str(Path(cache_dir).resolve())
+    if key not in _caches:
+        _caches[key] = GMMCache(cache_dir)
+
+    return _caches[key]
@@ -0,0 +1,104 @@
+"""Batched linear algebra for the Gaussian mixture components."""
+
+import numpy as np
+import torch
+
+
+# feature dims up to which the closed-form (elementwise) kernels are used
+MAX_CLOSED_FORM_DIM = 3
+
+
+def _closed_form_precision_cholesky(covs):
+    """
+    Cholesky factors of the precision matrices of small (n_d <= 3) covariances,
+    written out entry by entry so that every step is one elementwise operation
+    over all components (no batched LAPACK calls).
+
+    Args:
+        covs: size (n_c, n_d, n_d) tensor
+
+    Returns:
+        prec_chol: size (n_c, n_d, n_d) tensor (upper-triangular)
+        log_det: size (n_c,) tensor; log-determinant of prec_chol
+        not_psd: size (n_c,) bool tensor; True where a pivot is not positive
+                 (equivalently, a leading principal minor is not positive)
+    """
+
+    n_d = covs.shape[-1]
+
+    # cov = L L^T, L lower-triangular
+    L = [[None] * n_d for _ in range(n_d)]
+    not_psd = torch.zeros(covs.shape[:-2], dtype=torch.bool, device=covs.device)
+    for j in range(n_d):
+        pivot = covs[..., j, j] - sum(L[j][k].square() for k in range(j))
+        not_psd |= ~(pivot > 0)
+        L[j][j] = pivot.clamp_min(torch.finfo(covs.dtype).tiny).sqrt()
+        for i in range(j + 1, n_d):
+            L[i][j] = (covs[..., i, j] - sum(L[i][k] * L[j][k] for k in range(j))) / L[j][j]
+
+    # M = L^{-1} (lower-triangular) by forward substitution; prec_chol = M^T
+    M = [[None] * n_d for _ in range(n_d)]
+    for i in range(n_d):
+        M[i][i] = 1 / L[i][i]
+        for j in range(i - 1, -1, -1):
+            M[i][j] = -sum(L[i][k] * M[k][j] for k in range(j, i)) * M[i][i]
+
+    zeros = torch.zeros_like(covs[..., 0, 0])
+    prec_chol = torch.stack([
+        torch.stack([M[j][i] if j >= i else zeros for j in range(n_d)], -1)
+        for i in range(n_d)
+    ], -2)
+    log_det = sum(torch.log(M[i][i]) for i in range(n_d))
+
+    return prec_chol, log_det, not_psd
+
+
+def compute_precision_cholesky(covs, safe_covs=None):
+    """
+    Factorize all covariance matrices at once. For n_d <= MAX_CLOSED_FORM_DIM 
+    (e.g., the 3-D localization features), the factors are computed in closed form.
+
+    Args:
+        covs: size (n_c, n_d, n_d) array or tensor
+        safe_covs: size (n_c, n_d, n_d) array or tensor
+                   (alternative covariance matrix to use in case cov is non-PSD)
+
+    Returns:
+        prec_chol: size (n_c, n_d, n_d) tensor; cholesky factors of the precision
+                   matrices (same convention as sklearn's precisions_cholesky_)
+        log_det: size (n_c,) tensor; log-determinant of prec_chol
+    """
+
+    covs = torch.as_tensor(covs)
+    if not torch.is_floating_point(covs):
+        covs = covs.double()
+    n_d = covs.shape[-1]
+
+    if n_d <= MAX_CLOSED_FORM_DIM:
+        prec_chol, log_det, not_psd = _closed_form_precision_cholesky(covs)
+        if not_psd.any():
+            if safe_covs is None:
+                raise np.linalg.LinAlgError("covariance matrix is not positive definite.")
+            safe_covs = torch.as_tensor(safe_covs).to(covs)
+            safe_prec_chol, safe_log_det, safe_not_psd = _closed_form_precision_cholesky(safe_covs[not_psd])
+            if safe_not_psd.any():
+                raise np.linalg.LinAlgError("covariance matrix is not positive definite.")
+            prec_chol[not_psd], log_det[not_psd] = safe_prec_chol, safe_log_det
+        return prec_chol, log_det
+
+    cov_chol, info = torch.linalg.cholesky_ex(covs)
+    not_psd = info > 0
+    if not_psd.any():
+        if safe_covs is None:
+            raise np.linalg.LinAlgError("covariance matrix is not positive definite.")
+        # taken when a CAVI M step produces a non-PSD covariance (e.g., a component 
+        # w/ too few or collinear spikes); that component falls back to safe_covs
+        safe_covs = torch.as_tensor(safe_covs).to(covs)
+        cov_chol = cov_chol.clone()
+        cov_chol[not_psd] = torch.linalg.cholesky(safe_covs[not_psd])
+
+    eye = torch.eye(n_d, dtype=covs.dtype, device=covs.device).expand_as(cov_chol)
+    prec_chol = torch.linalg.solve_triangular(cov_chol, eye, upper=False).transpose(-1, -2)
+    log_det = torch.log(torch.diagonal(prec_chol, dim1=-2, dim2=-1)).sum(-1)
+
+    return prec_chol, log_det
@@ -30,8 +30,75 @@ def to_device(x, device):
     return torch.tensor(x).to(device)
 
 
-
-
-
+class ConvergenceMonitor():
+    def __init__(
+        self, 
+        rtol=None, 
+        patience=1, 
+        smoothing=0., 
+        eval_every=1
+    ):
+        """
+        Track the ELBO of an iterative fit and decide when to stop.
+        
+        The fit has converged when the relative change of the (exponentially) 
+        smoothed ELBO stays below rtol for `patience` consecutive evaluations.
+        
+        Args:
+            rtol: relative tolerance on the change of the smoothed ELBO 
+                  (never stops early if None)
+            patience: number of consecutive evaluations below rtol before stopping
+            smoothing: weight of the previous smoothed ELBO in [0, 1) 
+                       (0 = no smoothing; useful for noisy stochastic ELBOs)
+            eval_every: evaluate the ELBO every eval_every iterations
+        """
+        
+        assert 0 <= smoothing < 1, "smoothing must be in [0, 1)."
+        assert eval_every >= 1, "eval_every must be a positive integer."
+        self.rtol = rtol
+        self.patience = patience
+        self.smoothing = smoothing
+        self.eval_every = eval_every
+        self.reset()
+        
+        
+    def reset(self):
+        self.elbos = []
+        self.n_iter_ = 0
+        self.converged_ = False
+        self._smoothed = None
+        self._n_below = 0
+        
+        
+    def should_evaluate(self, it, max_iter):
+        """Whether the ELBO is needed at (0-based) iteration it."""
+        return (it + 1) % self.eval_every == 0 or it + 1 == max_iter
+    
     
-    
\ No newline at end of file
+    def update(self, it, elbo):
+        """
+        Record the ELBO evaluated at (0-based) iteration it.
+        
+        Returns:
+            stop: bool; whether the fit has converged
+        """
+        
+        elbo = float(elbo)
+        self.elbos.append(elbo)
+        self.n_iter_ = it + 1
+        
+        prev = self._smoothed
+        if prev is None:
+            self._smoothed = elbo
+            return False
+        self._smoothed = self.smoothing * prev + (1 - self.smoothing) * elbo
+        
+        if self.rtol is None:
+            return False
+        if abs(self._smoothed - prev) <= self.rtol * abs(prev):
+            self._n_below += 1
+        else:
+            self._n_below = 0
+        self.converged_ = self._n_below >= self.patience
+        
+        return self.converged_
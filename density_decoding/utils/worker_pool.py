@@ -0,0 +1,202 @@
+"""Persistent worker pool w/ shared-memory arrays, reused across pipeline stages."""
+
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# shared memory blocks attached by this process (name -> SharedMemory)
+_attached = {}
+
+
+class SharedArray():
+    def __init__(self, array):
+        """
+        Numpy array placed in shared memory. The object is cheap to pickle
+        (only the name, shape and dtype are sent), so tasks can pass it to the
+        workers, which attach to the same memory instead of receiving a copy.
+
+        Args:
+            array: numpy array to copy into shared memory
+        """
+
+        array = np.ascontiguousarray(array)
+        self.shape, self.dtype = array.shape, array.dtype
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self._shm.name
+        _attached[self.name] = self._shm
+        self.array[...] = array
+
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+
+
+    @property
+    def array(self):
+        """numpy view of the shared memory (attached once per process)."""
+        if self.name not in _attached:
+            _detach_released()
+            _attached[self.name] = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=_attached[self.name].buf)
+
+
+    def release(self):
+        """Free the shared memory (only the process that created it can do so)."""
+        if self._shm is None:
+            return
+        _attached.pop(self.name, None)
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+
+def _detach_released():
+    """Unmap the blocks that were attached by this process but have since been released."""
+
+    for name in list(_attached):
+        try:
+            shared_memory.SharedMemory(name=name).close()
+        except FileNotFoundError:
+            try:
+                _attached.pop(name).close()
+            except BufferError:
+                # still referenced by a live view; retry at the next attach
+                pass
+
+
+def _init_worker():
+    # the tasks already vectorize their work; avoid oversubscribing the cores
+    import torch
+    torch.set_num_threads(1)
+
+
+def chunk_ranges(n_items, n_chunks, weights=None):
+    """
+    Split [0, n_items) into contiguous ranges of (roughly) equal total weight.
+
+    Args:
+        n_items: number of items
+        n_chunks: maximum number of ranges
+        weights: size (n_items,) array; cost of each item (uniform if None)
+
+    Returns:
+        ranges: a list of (start, end) tuples
+    """
+
+    weights = np.ones(n_items) if weights is None else np.asarray(weights, dtype=float)
+    cum_weights = np.cumsum(weights)
+    targets = cum_weights[-1] * np.arange(1, n_chunks) / n_chunks if n_items > 0 else []
+    bounds = np.unique(np.r_[0, np.searchsorted(cum_weights, targets, side="right"), n_items])
+
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+class WorkerPool():
+    def __init__(self, n_workers):
+        """
+        Long-lived pool of worker processes. The processes are started once (on
+        first use) and reused by every stage of a decoding session (GMM
+        initialization, weight matrices, folds); large inputs and outputs are
+        exchanged through shared memory rather than pickled into every task.
+
+        Args:
+            n_workers: number of worker processes
+        """
+
+        self.n_workers = n_workers
+        self._pool = None
+        self._shared = []
+
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes=self.n_workers, initializer=_init_worker)
+        return self._pool
+
+
+    def share(self, array):
+        """Copy an array into shared memory owned by this pool."""
+        shared = SharedArray(array)
+        self._shared.append(shared)
+        return shared
+
+
+    def release(self, *shared):
+        """Free shared arrays that are no longer needed."""
+        for x in shared:
+            x.release()
+            self._shared.remove(x)
+
+
+    def submit(self, func, *args):
+        """Run func(*args) on a worker; returns an AsyncResult."""
+        return self.pool.apply_async(func, args)
+
+
+    def map_ranges(self, func, n_items, args=(), weights=None, n_chunks=None):
+        """
+        Run func(start, end, *args) on chunked ranges of [0, n_items).
+
+        Args:
+            func: a picklable (module-level) function
+            n_items: number of items (e.g., trials)
+            args: extra arguments of func (pass large arrays as SharedArray)
+            weights: size (n_items,) array; cost of each item used to balance the chunks
+            n_chunks: number of chunks (4 per worker by default)
+
+        Returns:
+            outputs: a list of the outputs of each chunk (in range order)
+        """
+
+        n_chunks = 4 * self.n_workers if n_chunks is None else n_chunks
+        results = [
+            self.submit(func, start, end, *args)
+            for start, end in chunk_ranges(n_items, n_chunks, weights)
+        ]
+
+        return [result.get() for result in results]
+
+
+    def close(self):
+        """Stop the workers and free all shared arrays."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for x in self._shared:
+            x.release()
+        self._shared = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_pools = {}
+
+def get_worker_pool(n_workers):
+    """Return the pool shared by all calls in this process for n_workers."""
+
+    if n_workers not in _pools:
+        _pools[n_workers] = WorkerPool(n_workers)
+
+    return _pools[n_workers]
+
+
+@atexit.register
+def _close_pools():
+    for pool in _pools.values():
+        pool.close()
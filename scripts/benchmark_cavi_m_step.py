@@ -0,0 +1,80 @@
+"""benchmark the CAVI encoder M step against the per-(component, time bin) loop."""
+
+import argparse
+import time
+
+import torch
+from density_decoding.models.cavi import CAVI
+from density_decoding.utils.utils import safe_log, set_seed
+
+
+def loop_encode_m_step(cavi, s, r, y, mu, lam):
+    """Reference n_c x n_t double loop (the previous CAVI._encode_m_step)."""
+
+    for c in range(cavi.n_c):
+        no_c_idx = torch.cat([torch.arange(c), torch.arange(c+1, cavi.n_c)])
+        lam_sum_no_c = lam[no_c_idx,:,:].sum(0)
+        for t in range(cavi.n_t):
+            num1 = torch.einsum('i,il,->', r[cavi.train_ts[t],c], y[cavi.train_ts[t]], lam_sum_no_c[t,1])
+            denom1 = torch.einsum('ij,il->', r[cavi.train_ts[t]][:,no_c_idx], y[cavi.train_ts[t]])
+            num0 = torch.einsum('i,il,->', r[cavi.train_ts[t],c], 1-y[cavi.train_ts[t]], lam_sum_no_c[t,0])
+            denom0 = torch.einsum('ij,il->', r[cavi.train_ts[t]][:,no_c_idx], 1-y[cavi.train_ts[t]])
+            lam[c,t,1], lam[c,t,0] = num1 / denom1, num0 / denom0
+
+    norm_lam = safe_log(lam) - safe_log(lam.sum(0))
+    norm = r.sum(0)
+    mu = torch.einsum('j,ij,ip->jp', 1/norm, r, s)
+    cov = torch.stack([torch.einsum(
+        ',i,ip,id->pd', 1/norm[c], r[:,c], s-mu[c], s-mu[c]) for c in range(cavi.n_c)])
+
+    return mu, cov, lam, norm_lam
+
+
+if __name__ == "__main__":
+    set_seed(666)
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n_spikes", default=100_000, type=int)
+    ap.add_argument("--n_c", default=300, type=int)
+    ap.add_argument("--n_t", default=30, type=int)
+    ap.add_argument("--n_d", default=3, type=int)
+    ap.add_argument("--n_trials", default=100, type=int)
+    ap.add_argument("--skip_loop", action="store_true")
+    args = ap.parse_args()
+
+    # -- synthetic data
+    trial_idxs = torch.randint(args.n_trials, (args.n_spikes,))
+    time_idxs = torch.randint(args.n_t, (args.n_spikes,))
+    y_k = torch.randint(2, (args.n_trials,)).double()
+    s = torch.randn((args.n_spikes, args.n_d)) * 10
+    y = y_k[trial_idxs].reshape(-1, 1)
+    r = torch.softmax(torch.randn((args.n_spikes, args.n_c)), 1)
+    mu = torch.randn((args.n_c, args.n_d))
+    covs = torch.eye(args.n_d).repeat(args.n_c, 1, 1)
+    lam = torch.rand((args.n_c, args.n_t, 2)) + .5
+
+    cavi = CAVI(
+        init_means=mu.numpy(),
+        init_covs=covs.numpy(),
+        init_lambdas=lam.numpy(),
+        train_trial_idxs=[torch.argwhere(trial_idxs == k).reshape(-1) for k in range(args.n_trials)],
+        train_time_idxs=[torch.argwhere(time_idxs == t).reshape(-1) for t in range(args.n_t)],
+        test_trial_idxs=[],
+        test_time_idxs=[],
+    )
+
+    # -- benchmark
+    start = time.perf_counter()
+    new = cavi._encode_m_step(s, r, y, mu.clone(), lam.clone())
+    new_time = time.perf_counter() - start
+    print(f"vectorized M step: {new_time:.3f} sec")
+
+    if not args.skip_loop:
+        start = time.perf_counter()
+        ref = loop_encode_m_step(cavi, s, r, y, mu.clone(), lam.clone())
+        loop_time = time.perf_counter() - start
+        print(f"loop M step: {loop_time:.3f} sec ({loop_time / new_time:.0f}x slower)")
+
+        for name, x, x_ref in zip(["mu", "cov", "lam", "norm_lam"], new, ref):
+            print(f"max abs diff in {name}: {(x - x_ref).abs().max().item():.2e}")
+            assert torch.allclose(x, x_ref, rtol=1e-8, atol=1e-10), f"{name} does not match."
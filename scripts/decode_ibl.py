@@ -7,11 +7,12 @@ from pathlib import Path
 
 import numpy as np
 import torch
-from density_decoding.decode_pipeline import decode_pipeline
+from density_decoding.decode_pipeline import decode_pipeline, decode_folds_pipeline
 from density_decoding.decoders.behavior_decoder import (generic_decoder,
                                                         sliding_window_decoder)
 from density_decoding.utils.data_utils import IBLDataLoader
 from density_decoding.utils.utils import set_seed
+from density_decoding.utils.worker_pool import WorkerPool
 from sklearn.model_selection import KFold
 
 if __name__ == "__main__":
@@ -43,8 +44,26 @@ if __name__ == "__main__":
     g.add_argument("--max_iter", default=100, type=int)
     g.add_argument("--fast_compute", action="store_false", default=True)
     g.add_argument("--stochastic", action="store_false", default=True)
+    g.add_argument("--n_mc_samples", default=1, type=int)
+    g.add_argument("--rtol", default=None, type=float)
+    g.add_argument("--patience", default=10, type=int)
+    g.add_argument("--batch_folds", action="store_true", default=False)
+    g.add_argument(
+        "--prune_tol", default=None, type=float,
+        help="in the weight matrices, drop the mixture components whose weighted density "
+             "is provably below prune_tol times that of the nearest one (ADVI training is "
+             "not pruned by it); w/ very heterogeneous covariances the bound is loose and "
+             "the cost per spike still grows w/ the number of components"
+    )
+    g.add_argument(
+        "--n_neighbors", default=None, type=int,
+        help="evaluate each spike under at most n_neighbors components w/ the nearest "
+             "means, in training and in the weight matrices; bounds the cost per spike "
+             "but not the accuracy"
+    )
     g.add_argument("--device", default="cpu", type=str, choices=["cpu", "gpu"])
     g.add_argument("--n_workers", default=4, type=int)
+    g.add_argument("--gmm_cache_dir", default=None, type=str)
 
     args = ap.parse_args()
 
@@ -96,94 +115,67 @@ if __name__ == "__main__":
         print("no good Kilosort units found in this brain region.")
 
     # -- CV
-    kf = KFold(n_splits=5, shuffle=True, random_state=seed)
-    for i, (train, test) in enumerate(kf.split(behavior)):
-        print(f"Fold {i+1} / 5:")
-
-        saved_metrics, saved_y_obs, saved_y_pred = {}, {}, {}
-
-        weight_matrix = decode_pipeline(
-            ibl_data_loader,
-            bin_spike_features,
-            bin_trial_idxs,
-            bin_time_idxs,
-            thresholded_spike_count,
+    # one pool of workers for all stages and folds of this session
+    with WorkerPool(args.n_workers) as pool:
+        pipeline_args = dict(
             bin_behaviors=behavior,
             behavior_type=behavior_type,
-            train=train,
-            test=test,
             batch_size=args.batch_size,
             learning_rate=args.learning_rate,
             max_iter=args.max_iter,
             fast_compute=args.fast_compute,
             stochastic=args.stochastic,
+            n_mc_samples=args.n_mc_samples,
+            rtol=args.rtol,
+            patience=args.patience,
             # penalty_strength=args.penalty_strength,
             device=device,
             n_workers=args.n_workers,
+            gmm_cache_dir=args.gmm_cache_dir,
+            pool=pool,
+            prune_tol=args.prune_tol,
+            n_neighbors=args.n_neighbors,
         )
 
-        if behavior_type == "continuous":
-            print("thresholded:")
-            y_train, y_test, y_pred, metrics = sliding_window_decoder(
+        kf = KFold(n_splits=5, shuffle=True, random_state=seed)
+        folds = list(kf.split(behavior))
+
+        if args.batch_folds:
+            # train the models of all folds jointly
+            weight_matrices = decode_folds_pipeline(
+                ibl_data_loader,
+                bin_spike_features,
+                bin_trial_idxs,
+                bin_time_idxs,
                 thresholded_spike_count,
-                behavior,
-                train,
-                test,
-                behavior_type=behavior_type,
-                verbose=True,
-            )
-            saved_metrics.update(
-                {
-                    "thresholded": [
-                        metrics["r2"],
-                        metrics["mse"],
-                        metrics["corr"],
-                    ]
-                }
-            )
-            saved_y_obs.update({"thresholded": y_test})
-            saved_y_pred.update({"thresholded": y_pred})
-
-            print("density-based:")
-            y_train, y_test, y_pred, metrics = sliding_window_decoder(
-                weight_matrix,
-                behavior,
-                train,
-                test,
-                behavior_type=behavior_type,
-                verbose=True,
-            )
-            saved_metrics.update(
-                {
-                    "density_based": [
-                        metrics["r2"],
-                        metrics["mse"],
-                        metrics["corr"],
-                    ]
-                }
-            )
-            saved_y_obs.update({"density_based": y_test})
-            saved_y_pred.update({"density_based": y_pred})
-
-            print("all Kilosort units:")
-            y_train, y_test, y_pred, metrics = sliding_window_decoder(
-                all_sorted_spike_count,
-                behavior,
-                train,
-                test,
-                behavior_type=behavior_type,
-                verbose=True,
+                trains=[train for train, _ in folds],
+                tests=[test for _, test in folds],
+                **pipeline_args,
             )
-            saved_metrics.update(
-                {"all_ks": [metrics["r2"], metrics["mse"], metrics["corr"]]}
-            )
-            saved_y_obs.update({"all_ks": y_test})
-            saved_y_pred.update({"all_ks": y_pred})
 
-            if not skip_good_ks:
-                print("good Kilosort units:")
+        for i, (train, test) in enumerate(folds):
+            print(f"Fold {i+1} / 5:")
+
+            saved_metrics, saved_y_obs, saved_y_pred = {}, {}, {}
+
+            if args.batch_folds:
+                weight_matrix = weight_matrices[i]
+            else:
+                weight_matrix = decode_pipeline(
+                    ibl_data_loader,
+                    bin_spike_features,
+                    bin_trial_idxs,
+                    bin_time_idxs,
+                    thresholded_spike_count,
+                    train=train,
+                    test=test,
+                    **pipeline_args,
+                )
+
+            if behavior_type == "continuous":
+                print("thresholded:")
                 y_train, y_test, y_pred, metrics = sliding_window_decoder(
-                    good_sorted_spike_count,
+                    thresholded_spike_count,
                     behavior,
                     train,
                     test,
@@ -192,85 +184,144 @@ if __name__ == "__main__":
                 )
                 saved_metrics.update(
                     {
-                        "good_ks": [
+                        "thresholded": [
                             metrics["r2"],
                             metrics["mse"],
                             metrics["corr"],
                         ]
                     }
                 )
-                saved_y_obs.update({"good_ks": y_test})
-                saved_y_pred.update({"good_ks": y_pred})
+                saved_y_obs.update({"thresholded": y_test})
+                saved_y_pred.update({"thresholded": y_pred})
 
-        elif behavior_type == "discrete":
-            print("thresholded:")
-            y_train, y_test, y_pred, metrics = generic_decoder(
-                thresholded_spike_count,
-                behavior,
-                train,
-                test,
-                behavior_type=behavior_type,
-                verbose=True,
-            )
-            saved_metrics.update({"thresholded": metrics["acc"]})
-            saved_y_obs.update({"thresholded": y_test})
-            saved_y_pred.update({"thresholded": y_pred})
-
-            print("density-based:")
-            y_train, y_test, y_pred, metrics = generic_decoder(
-                weight_matrix,
-                behavior,
-                train,
-                test,
-                behavior_type=behavior_type,
-                verbose=True,
-            )
-            saved_metrics.update({"density_based": metrics["acc"]})
-            saved_y_obs.update({"density_based": y_test})
-            saved_y_pred.update({"density_based": y_pred})
-
-            print("all Kilosort units:")
-            _, y_test, ks_pred, metrics = generic_decoder(
-                all_sorted_spike_count,
-                behavior,
-                train,
-                test,
-                behavior_type=behavior_type,
-                verbose=True,
-            )
-            saved_metrics.update({"all_ks": metrics["acc"]})
-            saved_y_obs.update({"all_ks": y_test})
-            saved_y_pred.update({"all_ks": y_pred})
-
-            if not skip_good_ks:
-                print("good Kilosort units:")
-                _, _, _, _ = generic_decoder(
-                    good_sorted_spike_count,
+                print("density-based:")
+                y_train, y_test, y_pred, metrics = sliding_window_decoder(
+                    weight_matrix,
                     behavior,
                     train,
                     test,
                     behavior_type=behavior_type,
                     verbose=True,
                 )
-                saved_metrics.update({"good_ks": metrics["acc"]})
-                saved_y_obs.update({"good_ks": y_test})
-                saved_y_pred.update({"good_ks": y_pred})
-
-        # -- save outputs
-        save_path = {}
-        out_path = Path(args.out_path)
-        for res in ["metrics", "y_obs", "y_pred"]:
-            save_path.update(
-                {
-                    res: out_path
-                    / args.pid
-                    / args.behavior
-                    / args.brain_region
-                    / res
-                }
-            )
-            os.makedirs(save_path[res], exist_ok=True)
+                saved_metrics.update(
+                    {
+                        "density_based": [
+                            metrics["r2"],
+                            metrics["mse"],
+                            metrics["corr"],
+                        ]
+                    }
+                )
+                saved_y_obs.update({"density_based": y_test})
+                saved_y_pred.update({"density_based": y_pred})
+
+                print("all Kilosort units:")
+                y_train, y_test, y_pred, metrics = sliding_window_decoder(
+                    all_sorted_spike_count,
+                    behavior,
+                    train,
+                    test,
+                    behavior_type=behavior_type,
+                    verbose=True,
+                )
+                saved_metrics.update(
+                    {"all_ks": [metrics["r2"], metrics["mse"], metrics["corr"]]}
+                )
+                saved_y_obs.update({"all_ks": y_test})
+                saved_y_pred.update({"all_ks": y_pred})
+
+                if not skip_good_ks:
+                    print("good Kilosort units:")
+                    y_train, y_test, y_pred, metrics = sliding_window_decoder(
+                        good_sorted_spike_count,
+                        behavior,
+                        train,
+                        test,
+                        behavior_type=behavior_type,
+                        verbose=True,
+                    )
+                    saved_metrics.update(
+                        {
+                            "good_ks": [
+                                metrics["r2"],
+                                metrics["mse"],
+                                metrics["corr"],
+                            ]
+                        }
+                    )
+                    saved_y_obs.update({"good_ks": y_test})
+                    saved_y_pred.update({"good_ks": y_pred})
+
+            elif behavior_type == "discrete":
+                print("thresholded:")
+                y_train, y_test, y_pred, metrics = generic_decoder(
+                    thresholded_spike_count,
+                    behavior,
+                    train,
+                    test,
+                    behavior_type=behavior_type,
+                    verbose=True,
+                )
+                saved_metrics.update({"thresholded": metrics["acc"]})
+                saved_y_obs.update({"thresholded": y_test})
+                saved_y_pred.update({"thresholded": y_pred})
+
+                print("density-based:")
+                y_train, y_test, y_pred, metrics = generic_decoder(
+                    weight_matrix,
+                    behavior,
+                    train,
+                    test,
+                    behavior_type=behavior_type,
+                    verbose=True,
+                )
+                saved_metrics.update({"density_based": metrics["acc"]})
+                saved_y_obs.update({"density_based": y_test})
+                saved_y_pred.update({"density_based": y_pred})
+
+                print("all Kilosort units:")
+                _, y_test, ks_pred, metrics = generic_decoder(
+                    all_sorted_spike_count,
+                    behavior,
+                    train,
+                    test,
+                    behavior_type=behavior_type,
+                    verbose=True,
+                )
+                saved_metrics.update({"all_ks": metrics["acc"]})
+                saved_y_obs.update({"all_ks": y_test})
+                saved_y_pred.update({"all_ks": y_pred})
+
+                if not skip_good_ks:
+                    print("good Kilosort units:")
+                    _, _, _, _ = generic_decoder(
+                        good_sorted_spike_count,
+                        behavior,
+                        train,
+                        test,
+                        behavior_type=behavior_type,
+                        verbose=True,
+                    )
+                    saved_metrics.update({"good_ks": metrics["acc"]})
+                    saved_y_obs.update({"good_ks": y_test})
+                    saved_y_pred.update({"good_ks": y_pred})
+
+            # -- save outputs
+            save_path = {}
+            out_path = Path(args.out_path)
+            for res in ["metrics", "y_obs", "y_pred"]:
+                save_path.update(
+                    {
+                        res: out_path
+                        / args.pid
+                        / args.behavior
+                        / args.brain_region
+                        / res
+                    }
+                )
+                os.makedirs(save_path[res], exist_ok=True)
+
+            np.save(save_path["metrics"] / f"fold_{i+1}.npy", saved_metrics)
+            np.save(save_path["y_obs"] / f"fold_{i+1}.npy", saved_y_obs)
+            np.save(save_path["y_pred"] / f"fold_{i+1}.npy", saved_y_pred)
 
-        np.save(save_path["metrics"] / f"fold_{i+1}.npy", saved_metrics)
-        np.save(save_path["y_obs"] / f"fold_{i+1}.npy", saved_y_obs)
-        np.save(save_path["y_pred"] / f"fold_{i+1}.npy", saved_y_pred)
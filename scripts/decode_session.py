@@ -22,6 +22,7 @@ def decode(
     batch_size=None,
     max_iter=None,
     learning_rate=None,
+    n_mc_samples=None,
 ):
     extra = []
     if batch_size is not None:
@@ -30,6 +31,8 @@ def decode(
         extra.append(f"--max_iter={max_iter}")
     if learning_rate is not None:
         extra.append(f"--learning_rate={learning_rate}")
+    if n_mc_samples is not None:
+        extra.append(f"--n_mc_samples={n_mc_samples}")
     return subprocess.run(
         [
             sys.executable,
@@ -0,0 +1,137 @@
+import pytest
+import numpy as np
+import torch
+import torch.distributions as D
+from sklearn.mixture import GaussianMixture
+from density_decoding.models import advi as advi_module
+from density_decoding.models.advi import ADVI, FoldADVI
+from density_decoding.models.gaussian import GaussianComponentBank
+
+
+@pytest.fixture
+def double_precision():
+    # as set by set_seed in the decoding pipeline
+    dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.double)
+    yield
+    torch.set_default_dtype(dtype)
+
+
+def _fit_gmm(n_spikes=2000, n_c=15, n_d=3, seed=0):
+    rng = np.random.default_rng(seed)
+    s = rng.normal(size=(n_spikes, n_d)) * 3
+    return s, GaussianMixture(n_c, random_state=seed).fit(s)
+
+
+def test_pruned_elbo_matches_dense_with_nonuniform_weights():
+    n_t, n_trials = 5, 4
+    s, gmm = _fit_gmm()
+    rng = np.random.default_rng(1)
+    trial_idxs = torch.tensor(np.sort(rng.integers(n_trials, size=len(s))))
+    time_idxs = torch.tensor(rng.integers(n_t, size=len(s)))
+    behaviors = torch.tensor(rng.normal(size=(n_trials, n_t)))
+    s = torch.tensor(s)
+
+    elbos = []
+    for prune_tol in [None, 1e-3]:
+        torch.manual_seed(0)
+        advi = ADVI(n_t, gmm, "cpu", prune_tol=prune_tol)
+        # mixing proportions far from uniform, where pruning by density alone fails
+        advi.b_mu.data = torch.linspace(-50., 50., advi.n_c)
+        torch.manual_seed(1)
+        model_params = advi(behaviors, n_mc_samples=2)
+        elbos.append(advi.compute_elbo(
+            s, trial_idxs, time_idxs, model_params, scaling_factor=1.,
+            spike_ll=advi.compute_log_likelihood(s)
+        ).item())
+
+    assert np.isclose(elbos[0], elbos[1], rtol=1e-12)
+
+
+def test_pruned_responsibility_sums_within_tolerance():
+    n_segments, prune_tol = 6, 1e-6
+    s, gmm = _fit_gmm()
+    rng = np.random.default_rng(1)
+    segment_idxs = rng.integers(n_segments, size=len(s))
+    log_weights = rng.normal(size=(n_segments, gmm.n_components)) * 20
+    log_weights -= np.logaddexp.reduce(log_weights, 1, keepdims=True)
+
+    dense = GaussianComponentBank(gmm.means_, gmm.covariances_)
+    pruned = GaussianComponentBank(gmm.means_, gmm.covariances_, prune_tol=prune_tol)
+    ref = dense.responsibility_sums(s, segment_idxs, log_weights)
+    out = pruned.responsibility_sums(s, segment_idxs, log_weights)
+
+    # each dropped component has a responsibility below prune_tol (relative to the nearest)
+    assert torch.abs(out - ref).max() <= 2 * gmm.n_components * prune_tol * len(s)
+
+
+def test_invalid_pruning_settings_raise():
+    _, gmm = _fit_gmm(n_spikes=200, n_c=3)
+    for kwargs in [dict(prune_tol=0.), dict(prune_tol=-1e-3), dict(prune_tol=2.), dict(n_neighbors=0)]:
+        with pytest.raises(ValueError):
+            GaussianComponentBank(gmm.means_, gmm.covariances_, **kwargs)
+
+
+def test_train_advi_without_precomputed_log_likelihood(monkeypatch):
+    n_t, n_trials = 5, 6
+    s, gmm = _fit_gmm(n_spikes=600, n_c=5)
+    rng = np.random.default_rng(1)
+    trial_idxs = torch.tensor(rng.integers(n_trials, size=len(s)))
+    time_idxs = torch.tensor(rng.integers(n_t, size=len(s)))
+    behaviors = torch.tensor(rng.normal(size=(n_trials, n_t)))
+    s = torch.tensor(s)
+
+    elbos = []
+    for max_cached in [advi_module.MAX_CACHED_LOG_LIKELIHOOD, 0]:
+        monkeypatch.setattr(advi_module, "MAX_CACHED_LOG_LIKELIHOOD", max_cached)
+        torch.manual_seed(0)
+        advi = ADVI(n_t, gmm, "cpu")
+        elbos.append(advi_module.train_advi(
+            advi, s, behaviors, trial_idxs, time_idxs, [[0, 1, 2], [3, 4, 5]],
+            torch.optim.Adam(advi.parameters(), lr=1e-2), max_iter=10, stochastic=False
+        ))
+
+    assert np.allclose(elbos[0], elbos[1], rtol=1e-12)
+
+
+def test_fold_elbos_match_separate_advi_models(monkeypatch, double_precision):
+    # w/o sampling noise, both models see the same b and beta
+    monkeypatch.setattr(D.Normal, "rsample", lambda self, sample_shape=torch.Size(): 
+                        self.loc.expand(sample_shape + self.loc.shape))
+    n_t, n_trials = 5, 6
+    s, gmm = _fit_gmm(n_spikes=1000, n_c=6)
+    rng = np.random.default_rng(1)
+    trial_idxs = torch.tensor(np.sort(rng.integers(n_trials, size=len(s))))
+    time_idxs = torch.tensor(rng.integers(n_t, size=len(s)))
+    behaviors = torch.tensor(rng.normal(size=(n_trials, n_t)))
+    s = torch.tensor(s)
+    fold_trials, scaling_factors = [[0, 1, 2, 3], [2, 3, 4, 5]], [.5, 2.]
+
+    torch.manual_seed(0)
+    fold_advi = FoldADVI(len(fold_trials), n_t, gmm, "cpu")
+    spike_ll = fold_advi.compute_log_likelihood(s)
+    spike_idxs, pair_idxs, pair_folds = [], [], []
+    for f, trials in enumerate(fold_trials):
+        idxs = torch.nonzero(torch.isin(trial_idxs, torch.tensor(trials))).reshape(-1)
+        spike_idxs.append(idxs)
+        pair_idxs.append(torch.searchsorted(torch.tensor(trials), trial_idxs[idxs]) + len(pair_folds))
+        pair_folds.extend([f] * len(trials))
+    spike_idxs, pair_idxs = torch.cat(spike_idxs), torch.cat(pair_idxs)
+    model_params = fold_advi(
+        behaviors[sum(fold_trials, [])], torch.tensor(pair_folds), [0, 1], n_mc_samples=2
+    )
+    elbos = fold_advi.compute_elbo(
+        spike_ll[spike_idxs], pair_idxs, time_idxs[spike_idxs], model_params, 
+        torch.tensor(scaling_factors)
+    )
+
+    for f, trials in enumerate(fold_trials):
+        advi = ADVI(n_t, gmm, "cpu")
+        for name in ["b_mu", "b_log_sig", "beta_mu", "beta_log_sig"]:
+            getattr(advi, name).data = getattr(fold_advi, name)[f].data.clone()
+        mask = torch.isin(trial_idxs, torch.tensor(trials))
+        elbo = advi.compute_elbo(
+            s[mask], trial_idxs[mask], time_idxs[mask], advi(behaviors[trials], n_mc_samples=2), 
+            scaling_factor=scaling_factors[f]
+        )
+        assert np.isclose(elbos[f].item(), elbo.item(), rtol=1e-12)
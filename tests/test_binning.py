@@ -0,0 +1,141 @@
+import numpy as np
+from density_decoding.utils.binning import (
+    BinnedSpikes,
+    bin_aligned_windows,
+    bin_trial_means,
+    bin_trial_windows,
+    compute_spike_count_histogram,
+    sum_trial_bins,
+)
+
+
+def _session(seed=0, n_spikes=5000, n_trials=12, n_t_bins=10, trial_length=1.):
+    rng = np.random.default_rng(seed)
+    times = np.sort(rng.uniform(0, 30, n_spikes))
+    starts = np.sort(rng.uniform(0, 28, n_trials))
+    t_binning = np.arange(n_t_bins) * trial_length / n_t_bins
+    return rng, times, starts, starts + trial_length, t_binning
+
+
+def _loop_bin_trial_windows(times, starts, ends, t_binning, n_t_bins):
+    """Reference per-trial masks (the previous BaseDataLoader.process_spike_features)."""
+
+    event_idxs, trial_idxs, time_idxs = [], [], []
+    for k in range(len(starts)):
+        idxs = np.nonzero(np.logical_and(times >= starts[k], times <= ends[k]))[0]
+        t_bins = np.digitize(times[idxs] - times[idxs].min(), t_binning, right=False) - 1
+        for t in range(n_t_bins):
+            event_idxs.append(idxs[t_bins == t])
+            trial_idxs.append(np.full((t_bins == t).sum(), k))
+            time_idxs.append(np.full((t_bins == t).sum(), t))
+
+    return np.concatenate(event_idxs), np.concatenate(trial_idxs), np.concatenate(time_idxs)
+
+
+def test_bin_trial_windows_matches_loop():
+    rng, times, starts, ends, t_binning = _session()
+    ref = _loop_bin_trial_windows(times, starts, ends, t_binning, len(t_binning))
+    out = bin_trial_windows(times, starts, ends, t_binning, len(t_binning))
+    for x, x_ref in zip(out, ref):
+        np.testing.assert_array_equal(x, x_ref)
+
+    # unsorted times give the indices of the original events
+    order = rng.permutation(len(times))
+    ref = _loop_bin_trial_windows(times[order], starts, ends, t_binning, len(t_binning))
+    out = bin_trial_windows(times[order], starts, ends, t_binning, len(t_binning))
+    for x, x_ref in zip(out, ref):
+        np.testing.assert_array_equal(x, x_ref)
+
+
+def test_binned_spikes_matches_nested():
+    rng, times, starts, ends, t_binning = _session()
+    n_t_bins = len(t_binning)
+    features = np.c_[rng.integers(0, 4, len(times)), rng.normal(size=(len(times), 3))]
+    event_idxs, trial_idxs, time_idxs = bin_trial_windows(times, starts, ends, t_binning, n_t_bins)
+    x = BinnedSpikes(features[event_idxs], trial_idxs, time_idxs, len(starts), n_t_bins)
+    nested = [[
+        features[event_idxs[(trial_idxs == k) & (time_idxs == t)]] for t in range(n_t_bins)
+    ] for k in range(len(starts))]
+
+    for k in range(len(starts)):
+        for t in range(n_t_bins):
+            np.testing.assert_array_equal(x[k][t], nested[k][t])
+    np.testing.assert_array_equal(BinnedSpikes.from_nested(nested).offsets, x.offsets)
+
+    trials = [7, 2, 5]
+    spike_features, _, _ = x.select_trials(trials)
+    np.testing.assert_array_equal(
+        spike_features, np.concatenate([nested[k][t] for k in sorted(trials) for t in range(n_t_bins)])
+    )
+
+
+def test_spike_count_histogram_matches_loop():
+    rng, times, starts, ends, t_binning = _session()
+    n_t_bins, n_units = len(t_binning), 7
+    units = rng.integers(0, n_units, len(times))
+
+    # reference per-trial np.add.at (the previous compute_spike_count_matrix)
+    ref = np.zeros((len(starts), n_units, n_t_bins))
+    for k in range(len(starts)):
+        mask = np.logical_and(times >= starts[k], times <= ends[k])
+        t_bins = np.digitize(times[mask] - times[mask].min(), t_binning, right=False) - 1
+        np.add.at(ref[k], (units[mask], t_bins), 1)
+
+    out = compute_spike_count_histogram(times, units, starts, ends, t_binning, n_t_bins, n_units)
+    np.testing.assert_array_equal(out, ref)
+    out = compute_spike_count_histogram(
+        times, units, starts, ends, t_binning, n_t_bins, n_units, sparse=True
+    )
+    np.testing.assert_array_equal(out.toarray().reshape(ref.shape), ref)
+
+
+def test_bin_trial_means_matches_loop():
+    rng, times, starts, ends, t_binning = _session(n_spikes=800)
+    n_t_bins = len(t_binning)
+    values = rng.normal(size=(len(times), 2))
+
+    # reference per-trial means (the previous process_behaviors)
+    ref = np.full((len(starts), n_t_bins, 2), np.nan)
+    for k in range(len(starts)):
+        mask = np.logical_and(times >= starts[k], times <= ends[k])
+        t_bins = np.digitize(times[mask] - times[mask].min(), t_binning, right=False) - 1
+        for t in range(n_t_bins):
+            if (t_bins == t).any():
+                ref[k, t] = values[mask][t_bins == t].mean(0)
+
+    out = bin_trial_means(times, values, starts, ends, t_binning, n_t_bins)
+    np.testing.assert_allclose(out, ref, rtol=1e-12)
+    np.testing.assert_allclose(
+        bin_trial_means(times, values[:,0], starts, ends, t_binning, n_t_bins), ref[...,0], rtol=1e-12
+    )
+
+
+def test_bin_aligned_windows_matches_loop():
+    rng, times, align_times, _, _ = _session()
+    pre_time, post_time, bin_size = .4, 1., .05
+    weights = rng.normal(size=len(times))
+
+    # reference per-trial bincounts (the previous bin_spikes)
+    n_bins_pre, n_bins_post = int(np.ceil(pre_time / bin_size)), int(np.ceil(post_time / bin_size))
+    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+    ts = align_times[:, None] + tscale
+    epoch_idxs = np.searchsorted(times, np.c_[ts[:, 0], ts[:, -1]])
+    ref_counts = np.zeros((len(align_times), n_bins_pre + n_bins_post))
+    ref_sums = np.zeros_like(ref_counts)
+    for i, (ep, t) in enumerate(zip(epoch_idxs, ts)):
+        xind = np.floor((times[ep[0]:ep[1]] - t[0]) / bin_size).astype(np.int64)
+        ref_counts[i] = np.bincount(xind, minlength=tscale.size)[:-1]
+        ref_sums[i] = np.bincount(xind, minlength=tscale.size, weights=weights[ep[0]:ep[1]])[:-1]
+
+    event_idxs, trial_idxs, time_idxs, bin_centers = bin_aligned_windows(
+        times, align_times, pre_time, post_time, bin_size
+    )
+    n_bins = len(bin_centers)
+    np.testing.assert_allclose(bin_centers, (tscale[:-1] + tscale[1:]) / 2)
+    np.testing.assert_array_equal(
+        sum_trial_bins(trial_idxs, time_idxs, len(align_times), n_bins), ref_counts
+    )
+    np.testing.assert_allclose(
+        sum_trial_bins(trial_idxs, time_idxs, len(align_times), n_bins, weights[event_idxs]),
+        ref_sums, rtol=1e-12, atol=1e-12
+    )
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import torch
+from density_decoding.models.cavi import CAVI
+
+# the reference loop lives w/ the benchmark that times it
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+from benchmark_cavi_m_step import loop_encode_m_step
+
+
+def test_encode_m_step_matches_loop():
+    torch.manual_seed(0)
+    n_spikes, n_c, n_t, n_d, n_trials = 2000, 8, 5, 3, 20
+
+    trial_idxs = torch.randint(n_trials, (n_spikes,))
+    time_idxs = torch.randint(n_t, (n_spikes,))
+    y_k = torch.randint(2, (n_trials,)).double()
+    s = torch.randn((n_spikes, n_d), dtype=torch.double) * 10
+    y = y_k[trial_idxs].reshape(-1, 1)
+    r = torch.softmax(torch.randn((n_spikes, n_c), dtype=torch.double), 1)
+    mu = torch.randn((n_c, n_d), dtype=torch.double)
+    covs = torch.eye(n_d, dtype=torch.double).repeat(n_c, 1, 1)
+    lam = torch.rand((n_c, n_t, 2), dtype=torch.double) + .5
+
+    cavi = CAVI(
+        init_means=mu.numpy(),
+        init_covs=covs.numpy(),
+        init_lambdas=lam.numpy(),
+        train_trial_idxs=[torch.argwhere(trial_idxs == k).reshape(-1) for k in range(n_trials)],
+        train_time_idxs=[torch.argwhere(time_idxs == t).reshape(-1) for t in range(n_t)],
+        test_trial_idxs=[],
+        test_time_idxs=[],
+    )
+
+    new = cavi._encode_m_step(s, r, y, mu.clone(), lam.clone())
+    ref = loop_encode_m_step(cavi, s, r, y, mu.clone(), lam.clone())
+
+    for name, x, x_ref in zip(["mu", "cov", "lam", "norm_lam"], new, ref):
+        assert torch.allclose(x, x_ref, rtol=1e-8, atol=1e-10), f"{name} does not match."
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.mixture import GaussianMixture
+
+# needs the IBL loaders (one, brainbox, ibllib) and isosplit
+data_utils = pytest.importorskip("density_decoding.utils.data_utils")
+
+
+def test_factorize_matches_pandas():
+    values = np.random.default_rng(0).choice([7, 3, 11, 5, 0], size=200)
+    uniques, labels = data_utils._factorize(values)
+    ref_labels, ref_uniques = pd.factorize(values)
+    np.testing.assert_array_equal(uniques, ref_uniques)
+    np.testing.assert_array_equal(labels, ref_labels)
+
+
+def test_grouped_moments_match_single_component_gmm():
+    rng = np.random.default_rng(0)
+    counts = np.array([50, 0, 3, 200, 12])
+    spike_features = rng.normal(size=(counts.sum(), 3)) * rng.uniform(1, 5, 3)
+    label_offsets = np.r_[0, np.cumsum(counts)]
+
+    out_counts, means, covs = data_utils._estimate_gaussian_moments(spike_features, label_offsets)
+    np.testing.assert_array_equal(out_counts, counts[counts > 0])
+    for i, l in enumerate(np.flatnonzero(counts)):
+        gmm = GaussianMixture(1, covariance_type="full", reg_covar=1e-6).fit(
+            spike_features[label_offsets[l]:label_offsets[l+1]]
+        )
+        np.testing.assert_allclose(means[i], gmm.means_[0], rtol=1e-10)
+        np.testing.assert_allclose(covs[i], gmm.covariances_[0], rtol=1e-10, atol=1e-12)
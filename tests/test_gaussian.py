@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import torch
+import torch.distributions as D
+from density_decoding.models.gaussian import gaussian_log_prob
+from density_decoding.utils.linalg import compute_precision_cholesky
+
+
+def _random_covs(n_c, n_d, seed=0):
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(n_c, n_d, n_d))
+    return torch.tensor(A @ A.transpose(0, 2, 1) + .1 * np.eye(n_d))
+
+
+@pytest.mark.parametrize("n_d", [1, 2, 3, 4, 5])
+def test_precision_cholesky_factorizes_the_precision(n_d):
+    covs = _random_covs(8, n_d)
+    prec_chol, log_det = compute_precision_cholesky(covs)
+
+    torch.testing.assert_close(prec_chol @ prec_chol.transpose(-1, -2), torch.linalg.inv(covs))
+    torch.testing.assert_close(prec_chol, torch.triu(prec_chol))
+    torch.testing.assert_close(log_det, -.5 * torch.logdet(covs))
+
+
+@pytest.mark.parametrize("n_d", [1, 2, 3, 4, 5])
+def test_log_prob_matches_multivariate_normal(n_d):
+    torch.manual_seed(0)
+    covs = _random_covs(8, n_d)
+    means = torch.randn((8, n_d), dtype=torch.double)
+    s = torch.randn((300, n_d), dtype=torch.double) * 3
+    ref = D.MultivariateNormal(means, covs).log_prob(s[:, None])
+
+    prec_chol, log_det = compute_precision_cholesky(covs)
+    torch.testing.assert_close(gaussian_log_prob(s, means, prec_chol, log_det), ref)
+    # any square factor of the precision gives the same densities (e.g., lower-triangular)
+    Q = torch.linalg.qr(torch.randn((8, n_d, n_d), dtype=torch.double))[0]
+    torch.testing.assert_close(gaussian_log_prob(s, means, prec_chol @ Q, log_det), ref)
+
+
+@pytest.mark.parametrize("n_d", [2, 5])
+def test_non_psd_covariances_fall_back_to_safe_covs(n_d):
+    covs, safe_covs = _random_covs(4, n_d), _random_covs(4, n_d, seed=1)
+    covs[1] = -covs[1]
+    prec_chol, _ = compute_precision_cholesky(covs, safe_covs)
+    ref, _ = compute_precision_cholesky(torch.stack([covs[0], safe_covs[1], covs[2], covs[3]]))
+    torch.testing.assert_close(prec_chol, ref)
+
+    with pytest.raises(np.linalg.LinAlgError):
+        compute_precision_cholesky(covs)
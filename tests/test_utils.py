@@ -0,0 +1,44 @@
+import numpy as np
+from density_decoding.utils.utils import ConvergenceMonitor
+
+
+def _run(monitor, elbos, max_iter=None):
+    """Feed the ELBOs as train_advi does; returns the number of iterations run."""
+
+    max_iter = len(elbos) if max_iter is None else max_iter
+    monitor.reset()
+    for it in range(max_iter):
+        if monitor.should_evaluate(it, max_iter) and monitor.update(it, elbos[it]):
+            break
+    return monitor.n_iter_
+
+
+def test_monitor_stops_after_patience_evaluations_below_rtol():
+    elbos = [-100., -50., -40., -39.99, -39.98, -39.97, -39.96, -10.]
+    monitor = ConvergenceMonitor(rtol=1e-3, patience=3)
+    assert _run(monitor, elbos) == 6
+    assert monitor.converged_
+    assert monitor.elbos == elbos[:6]
+
+    # a large change resets the count
+    elbos = [-100., -99.99, -99.98, -50., -49.99, -49.98, -49.97]
+    assert _run(ConvergenceMonitor(rtol=1e-3, patience=3), elbos) == 7
+
+
+def test_monitor_without_rtol_runs_max_iter():
+    monitor = ConvergenceMonitor()
+    assert _run(monitor, [-1.] * 20) == 20
+    assert not monitor.converged_
+
+
+def test_monitor_smoothing_and_eval_every():
+    elbos = list(-100. + np.arange(30))
+    monitor = ConvergenceMonitor(eval_every=4, smoothing=.5)
+    assert _run(monitor, elbos, max_iter=30) == 30
+    # evaluated every 4 iterations and at the last one
+    assert monitor.elbos == [elbos[it] for it in [3, 7, 11, 15, 19, 23, 27, 29]]
+
+    smoothed = monitor.elbos[0]
+    for elbo in monitor.elbos[1:]:
+        smoothed = .5 * smoothed + .5 * elbo
+    assert np.isclose(monitor._smoothed, smoothed)
@@ -0,0 +1,41 @@
+import numpy as np
+from sklearn.mixture import GaussianMixture
+from density_decoding.models.advi import compute_posterior_weight_matrix
+from density_decoding.utils.binning import BinnedSpikes
+from density_decoding.utils.worker_pool import WorkerPool, chunk_ranges
+
+
+def test_chunk_ranges_cover_all_items():
+    weights = np.random.default_rng(0).integers(0, 50, 37)
+    for n_chunks in [1, 4, 100]:
+        ranges = chunk_ranges(len(weights), n_chunks, weights)
+        assert len(ranges) <= n_chunks
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(weights)
+        assert all(end == start for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]))
+
+
+def test_pooled_weight_matrix_matches_single_process():
+    rng = np.random.default_rng(0)
+    n_k, n_t, n_c, n_spikes = 10, 6, 5, 3000
+    s = rng.normal(size=(n_spikes, 3)) * 3
+    gmm = GaussianMixture(n_c, random_state=0).fit(s)
+    trial_idxs = np.sort(rng.integers(n_k, size=n_spikes))
+    time_idxs = rng.integers(n_t, size=n_spikes)
+    order = np.lexsort((time_idxs, trial_idxs))
+    x = BinnedSpikes(
+        np.c_[rng.integers(0, 4, n_spikes), s][order], trial_idxs[order], time_idxs[order], n_k, n_t
+    )
+    post_params = {
+        "b": rng.normal(size=n_c), "beta": rng.normal(size=(n_c, n_t)),
+        "means": gmm.means_, "covs": gmm.covariances_
+    }
+    train, test = np.array([0, 2, 3, 5, 6, 8, 9]), np.array([1, 4, 7])
+    y = rng.normal(size=n_k)
+
+    _, ref = compute_posterior_weight_matrix(x, y[train], y[test], train, test, post_params, n_workers=1)
+    with WorkerPool(2) as pool:
+        _, out = compute_posterior_weight_matrix(
+            x, y[train], y[test], train, test, post_params, pool=pool
+        )
+        assert pool._shared == []
+    np.testing.assert_allclose(out, ref, rtol=1e-12, atol=1e-12)